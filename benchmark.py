@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+
+"""
+网站下载器基准测试：在本地生成并提供合成网站，用不同的引擎配置爬取，统计速度及资源占用
+"""
+
+__author__ = 'StrayingCloud'
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import argparse
+
+
+PAGES = 10000  # 合成网站的页面数
+FANOUT = 5  # 每个页面链接的其他页面数
+CSS_NUM = 10  # css 文件数，css 里用 url() 引用图片
+IMAGE_NUM = 100  # 图片数
+IMAGE_SIZE = 2 * 1024  # 字节，每张图片的大小
+BINARY_EVERY = 100  # 每隔多少个页面链接一个大文件，0为没有大文件
+BINARY_SIZE = 1024 * 1024  # 字节，每个大文件的大小
+LATENCY = 0.0  # 秒，每个响应的固定延迟
+JITTER = 0.0  # 秒，每个响应额外的随机延迟上限
+ERROR_RATE = 0.0  # 返回503错误的响应比例
+RUNS = ['thread:32', 'async:1000']  # 默认的引擎配置，格式为'引擎:并发数[:页面处理进程数]'
+TOLERANCE = 0.2  # 与基准结果比较时，允许的页面速度下降比例
+
+
+class SyntheticSite(object):
+    '''
+    按需生成的合成网站，不占用磁盘：页面 i 链接页面 i*fanout+1 到 i*fanout+fanout，从首页可到达全部页面；
+    每个页面引用一个 css 和一张图片，css 用 url() 引用图片，部分页面链接大文件。
+
+    参数：
+        pages:          int,    页面数；
+        fanout:         int,    每个页面链接的其他页面数；
+        css_num:        int,    css 文件数；
+        image_num:      int,    图片数；
+        image_size:     int,    每张图片的字节数；
+        binary_every:   int,    每隔多少个页面链接一个大文件，0为没有大文件；
+        binary_size:    int,    每个大文件的字节数；
+        latency:        float,  每个响应的固定延迟秒数；
+        jitter:         float,  每个响应额外的随机延迟上限；
+        error_rate:     float,  返回503错误的响应比例；
+        seed:           int,    随机数种子，延迟及错误可重现。
+
+    例子：
+        site = SyntheticSite(pages=1000, latency=0.01)
+        body, content_type = site.render('/p/0.html')
+    '''
+
+    def __init__(self, pages=PAGES, fanout=FANOUT, css_num=CSS_NUM, image_num=IMAGE_NUM, image_size=IMAGE_SIZE,
+                 binary_every=BINARY_EVERY, binary_size=BINARY_SIZE, latency=LATENCY, jitter=JITTER,
+                 error_rate=ERROR_RATE, seed=0):
+        self.pages = pages
+        self.fanout = fanout
+        self.css_num = max(1, min(css_num, pages))
+        self.image_num = max(1, min(image_num, pages))
+        self.image_size = image_size
+        self.binary_every = binary_every
+        self.binary_size = binary_size
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def num_binaries(self):
+        return (self.pages + self.binary_every - 1) // self.binary_every if self.binary_every else 0
+
+    def num_resources(self):
+        '''
+        网站的链接总数：首页、页面、css、图片及大文件
+        '''
+        return 1 + self.pages + self.css_num + self.image_num + self.num_binaries()
+
+    def delay(self):
+        '''
+        返回本次响应的延迟秒数，及是否返回错误
+        '''
+        with self.lock:
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+            failed = self.random.random() < self.error_rate
+        return delay, failed
+
+    def render_page(self, i):
+        links = ''.join(
+            '<a href="/p/{0}.html">page {0}</a>\n'.format((i * self.fanout + k + 1) % self.pages)
+            for k in range(self.fanout)
+        )
+        binary = ''
+        if self.binary_every and i % self.binary_every == 0:
+            binary = '<a href="/bin/{}.zip">download</a>\n'.format(i // self.binary_every)
+        return (
+            '<html><head><meta charset="utf-8"><title>page {0}</title>\n'
+            '<link href="/css/{1}.css" rel="stylesheet"></head>\n'
+            '<body><h1>页面 {0}</h1>\n<img src="/img/{2}.png">\n{3}{4}'
+            '<p>{5}</p></body></html>\n'
+        ).format(i, i % self.css_num, i % self.image_num, links, binary, 'lorem ipsum ' * 50)
+
+    def render(self, path):
+        '''
+        返回路径对应的内容及类型，不存在返回 (None, None)
+        '''
+        path = path.split('?')[0]
+        if path in ('/', '/index.html'):
+            return '<html><body><a href="/p/0.html">start</a></body></html>\n'.encode('utf-8'), 'text/html'
+        name, _, suffix = path.rpartition('.')
+        directory, _, num = name.rpartition('/')
+        if not num.isdigit():
+            return None, None
+        num = int(num)
+        if directory == '/p' and suffix == 'html' and num < self.pages:
+            return self.render_page(num).encode('utf-8'), 'text/html; charset=utf-8'
+        if directory == '/css' and suffix == 'css' and num < self.css_num:
+            css = 'body {{ background: url("../img/{}.png") }}\n'.format(num % self.image_num)
+            return css.encode('utf-8'), 'text/css'
+        if directory == '/img' and suffix == 'png' and num < self.image_num:
+            return self.make_bytes(num, self.image_size), 'image/png'
+        if directory == '/bin' and suffix == 'zip' and num < self.num_binaries():
+            return self.make_bytes(num, self.binary_size), 'application/zip'
+        return None, None
+
+    def make_bytes(self, num, size):
+        block = '{:08d}'.format(num).encode('ascii')
+        return (block * (size // len(block) + 1))[:size]
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    '''
+    提供合成网站的 HTTP/1.1 处理器，支持 keep-alive，按网站设置注入延迟及503错误
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def respond(self, send_body):
+        site = self.server.site
+        delay, failed = site.delay()
+        if delay > 0:
+            time.sleep(delay)
+        if failed:
+            body, content_type, status = b'', 'text/plain', 503
+        else:
+            body, content_type = site.render(self.path)
+            status = 200
+            if body is None:
+                body, content_type, status = b'', 'text/plain', 404
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SiteServer(ThreadingHTTPServer):
+    '''
+    每个连接一个线程，加大监听队列以承受异步引擎的大量并发连接
+    '''
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def serve_site(site, host='127.0.0.1', port=0):
+    '''
+    在后台线程启动合成网站服务，返回 server，网址为 'http://host:server.server_port/'
+    '''
+    server = SiteServer((host, port), SiteHandler)
+    server.site = site
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_run(run):
+    '''
+    解析引擎配置，如'thread:32'、'async:1000:4'
+    '''
+    fields = run.split(':')
+    engine = fields[0]
+    if engine not in ('thread', 'async'):
+        raise ValueError('unknown engine: {}'.format(run))
+    concurrency = int(fields[1]) if len(fields) > 1 else None
+    processes = int(fields[2]) if len(fields) > 2 else 0
+    return engine, concurrency, processes
+
+
+def crawl(url, run, log_level):
+    '''
+    在子进程里运行：按引擎配置爬取网址，打印 JSON 格式的结果
+    '''
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import website_downloader as wd
+
+    wd.BELL = False
+    wd.logger.setLevel(log_level)
+    engine, concurrency, processes = parse_run(run)
+    if engine == 'async':
+        m = wd.AsyncManager(url, concurrency or wd.ASYNC_CONCURRENCY, wd.ASYNC_HOST_CONCURRENCY, processes=processes)
+    else:
+        wd.THREAD_NUM = concurrency or wd.THREAD_NUM
+        wd.scheduler.concurrency = wd.THREAD_NUM
+        m = wd.Manager(url, processes=processes)
+    start = time.perf_counter()
+    m.start()
+    seconds = time.perf_counter() - start
+
+    snapshot = wd.metrics.snapshot()
+    # Linux 下 ru_maxrss 单位为 KB，页面处理子进程取其中最大的
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    print(json.dumps({
+        'run': run,
+        'links': snapshot['histograms'].get('handle', {}).get('count', 0),
+        'bytes': snapshot['counters'].get('bytes', 0),
+        'retries': snapshot['counters'].get('retries', 0),
+        'failed': snapshot['counters'].get('failed', 0),
+        'seconds': round(seconds, 3),
+        'peak_rss_mb': round(rss / 1024, 1),
+    }))
+
+
+def run_benchmark(url, run, work_dir, log_level):
+    '''
+    在新的子进程及空目录里运行一次爬取，峰值内存互不影响，返回结果
+    '''
+    run_dir = os.path.join(work_dir, run.replace(':', '-'))
+    os.makedirs(run_dir)
+    cmd = [sys.executable, os.path.abspath(__file__), '--crawl', url, '--log-level', log_level, '--run', run]
+    output = subprocess.run(cmd, cwd=run_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    result['links_per_sec'] = round(result['links'] / result['seconds'], 1)
+    result['mb_per_sec'] = round(result['bytes'] / 1024 / 1024 / result['seconds'], 2)
+    return result
+
+
+def report(results, expected):
+    '''
+    打印结果表格
+    '''
+    print('{:<16}{:>10}{:>10}{:>12}{:>10}{:>10}{:>10}{:>10}{:>8}'.format(
+        'run', 'links', 'missing', 'links/s', 'MB/s', 'rss MB', 'time s', 'retries', 'failed'))
+    for r in results:
+        print('{:<16}{:>10}{:>10}{:>12}{:>10}{:>10}{:>10}{:>10}{:>8}'.format(
+            r['run'], r['links'], expected - r['links'], r['links_per_sec'], r['mb_per_sec'],
+            r['peak_rss_mb'], r['seconds'], r['retries'], r['failed']))
+
+
+def compare(results, baseline_path, tolerance):
+    '''
+    与基准结果比较，链接处理速度下降超过 tolerance 或链接数减少则返回 False
+    '''
+    with open(baseline_path, encoding='utf-8') as fp:
+        baseline = dict((r['run'], r) for r in json.load(fp)['results'])
+    passed = True
+    for r in results:
+        base = baseline.get(r['run'])
+        if base is None:
+            continue
+        ratio = r['links_per_sec'] / base['links_per_sec'] if base['links_per_sec'] else 1
+        ok = ratio >= 1 - tolerance and r['links'] >= base['links']
+        passed = passed and ok
+        print('{:<16} links/s {:.0%} of baseline, links {}/{} {}'.format(
+            r['run'], ratio, r['links'], base['links'], 'ok' if ok else 'REGRESSION'))
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', help="pages of the synthetic site, default={}".format(PAGES),
+                        type=int, default=PAGES)
+    parser.add_argument('--fanout', help="links to other pages per page, default={}".format(FANOUT),
+                        type=int, default=FANOUT)
+    parser.add_argument('--css', help="css files, default={}".format(CSS_NUM), type=int, default=CSS_NUM)
+    parser.add_argument('--images', help="images, default={}".format(IMAGE_NUM), type=int, default=IMAGE_NUM)
+    parser.add_argument('--image-size', help="bytes per image, default={}".format(IMAGE_SIZE),
+                        type=int, default=IMAGE_SIZE)
+    parser.add_argument('--binary-every', help="one large file every N pages, 0 for none, default={}".format(
+                        BINARY_EVERY), type=int, default=BINARY_EVERY)
+    parser.add_argument('--binary-size', help="bytes per large file, default={}".format(BINARY_SIZE),
+                        type=int, default=BINARY_SIZE)
+    parser.add_argument('--latency', help="seconds of latency per response, default={}".format(LATENCY),
+                        type=float, default=LATENCY)
+    parser.add_argument('--jitter', help="max extra random latency per response, default={}".format(JITTER),
+                        type=float, default=JITTER)
+    parser.add_argument('--error-rate', help="fraction of responses failing with 503, default={}".format(ERROR_RATE),
+                        type=float, default=ERROR_RATE)
+    parser.add_argument('--seed', help="random seed of latency and errors, default=0", type=int, default=0)
+    parser.add_argument('--run', help="engine config 'engine:concurrency[:processes]', repeatable, default={}".format(
+                        ' '.join(RUNS)), action='append', default=None)
+    parser.add_argument('--json', help="write the results to this JSON file", type=str, default=None)
+    parser.add_argument('--baseline', help="compare with a JSON file written by --json, exit 1 on regression",
+                        type=str, default=None)
+    parser.add_argument('--tolerance', help="allowed links/s drop against the baseline, default={}".format(TOLERANCE),
+                        type=float, default=TOLERANCE)
+    parser.add_argument('--keep', help="keep the downloaded sites", action='store_true')
+    parser.add_argument('--log-level', help="log level of the crawler, default=WARNING",
+                        type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='WARNING')
+    parser.add_argument('--crawl', help=argparse.SUPPRESS, type=str, default=None)
+    args = parser.parse_args()
+
+    # 子进程：只运行一次爬取
+    if args.crawl:
+        crawl(args.crawl, args.run[0], args.log_level)
+        sys.exit(0)
+
+    runs = args.run or RUNS
+    [parse_run(run) for run in runs]
+    site = SyntheticSite(args.pages, args.fanout, args.css, args.images, args.image_size, args.binary_every,
+                         args.binary_size, args.latency, args.jitter, args.error_rate, args.seed)
+    server = serve_site(site)
+    url = 'http://127.0.0.1:{}/'.format(server.server_port)
+    work_dir = tempfile.mkdtemp(prefix='website-benchmark-')
+    print('site: {}, {} links, work dir: {}'.format(url, site.num_resources(), work_dir))
+
+    results = []
+    try:
+        for run in runs:
+            results.append(run_benchmark(url, run, work_dir, args.log_level))
+            print('{}: {} links in {}s'.format(run, results[-1]['links'], results[-1]['seconds']))
+    finally:
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print()
+    report(results, site.num_resources())
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as fp:
+            json.dump({'site': vars(args), 'results': results}, fp, ensure_ascii=False, indent=2)
+    if args.baseline and not compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
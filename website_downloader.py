@@ -7,31 +7,89 @@
 __author__ = 'StrayingCloud'
 
 import threading
-from queue import Queue, Empty
+from array import array
+from collections import deque, OrderedDict
 from urllib import request
 from urllib import parse
 from http import cookiejar
-from urllib.request import Request, urljoin, urlretrieve, urlparse
+from http import client
+from urllib.error import URLError, HTTPError, ContentTooShortError
+from urllib.request import Request, urljoin, urlparse
+from urllib.robotparser import RobotFileParser
+from xml.etree.ElementTree import iterparse, ParseError
+from xml.sax.saxutils import escape
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import asyncio
+import bisect
+import codecs
+import contextlib
+import email.utils
+import fnmatch
+import gzip
+import hashlib
+import multiprocessing
+import io
+import json
+import math
 import time
 import re
 import socket
+import sqlite3
+import sys
 import os
+import random
 import logging
 import shutil
 import ssl
+import tarfile
 import traceback
+import uuid
+import zipfile
 from PyPDF2 import PdfFileReader
 import argparse
 
 
 THREAD_NUM = 32  # 默认开启的爬虫线程数
 TRY_ERROR_LINK_THREAD_NUM = 3  # 重新处理异常链接的爬虫线程数
-SPIDER_GET_LINK_TIMEOUT = 5  # 秒，获取链接的轮询时间
 SOCKET_DEFAULT_TIMEOUT = 5 * 60  # 秒, socket 默认超时
 SOCKET_DOWNLOAD_TIMEOUT = 1 * 60 * 60  # 秒，下载默认超时
 MAX_TRY = 6  # 每个请求最大尝试次数
 PORT = 80  # 网络端口
 ADD_HTML_SUFFIX = True  # 如果没有后缀则补'.html'
+USER_AGENT = 'Python-urllib/{}.{}'.format(*sys.version_info[:2])  # 与 urllib 默认相同，也用于匹配 robots.txt 规则
+BELL = True  # 下载完成后响铃提醒
+ASYNC_CONCURRENCY = 1000  # 异步引擎的全局并发请求数
+ASYNC_HOST_CONCURRENCY = 16  # 异步引擎对每个host的并发请求数
+MAX_REDIRECTS = 5  # 最大重定向次数
+POOL_SIZE = THREAD_NUM  # 每个host保持的空闲 keep-alive 连接数
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # 字节，下载文件时每次读写的块大小
+STATE_COMMIT_INTERVAL = 1  # 秒，爬取状态写入数据库的间隔
+ASSET_WORKER_RATIO = 0.5  # 页面未爬完时，小文件通道最多占用的爬虫比例
+MEDIA_WORKER_RATIO = 0.25  # 页面未爬完时，大文件通道最多占用的爬虫比例
+HOST_MEDIA_RATIO = 0.25  # 大文件通道最多占用每个host并发数的比例，至少1个
+LARGE_FILE_SIZE = 10 * 1024 * 1024  # 字节，HEAD 探测时超过此大小的文件放入大文件通道
+PATH_CACHE_SIZE = 100000  # 链接本地路径、相对路径缓存的最大条数
+HOST_RATE = 0  # 每个host每秒最多请求数，0为不限制
+BACKOFF_BASE = 1  # 秒，失败重试的首次退避时间，之后每次翻倍
+BACKOFF_MAX = 60  # 秒，失败重试的最大退避时间
+RETRY_AFTER_MAX = 60 * 60  # 秒，遵守 Retry-After 的最长暂停时间
+HOST_PAUSE_ERRORS = 3  # 没有 Retry-After 时，host 连续出现此数量的 429/503 才暂停整个 host
+RATE_WINDOW = 10  # 秒，统计每个host出错比例的窗口
+ERROR_RATE_THRESHOLD = 0.2  # 窗口内出错比例超过该值则降低请求速率
+MIN_HOST_RATE = 0.2  # 自动降速时每个host每秒最少请求数
+METRICS_INTERVAL = 10  # 秒，指标快照写入 JSON 文件的间隔
+SEEN_CAPACITY = 10 * 1000 * 1000  # 布隆过滤器按此链接数分配内存，超过后误判率升高，但仍由数据库确认
+BLOOM_ERROR_RATE = 0.01  # 布隆过滤器的误判率，误判时查询数据库确认
+SITEMAP_MAX_FILES = 1000  # 从 sitemap 放入链接时最多获取的 sitemap 文件数
+SITEMAP_MAX_URLS = 50000  # 每个 sitemap 文件最多的链接数，超过则拆分并生成 sitemap 索引
+HLS_WORKERS = 8  # 所有 HLS 播放列表共用的分片并发下载数
+HLS_MAX_DEPTH = 2  # 主播放列表里子播放列表的最大嵌套层数
+ARCHIVE_MAX_SIZE = 1024 * 1024 * 1024  # 字节，归档文件超过此大小后换新文件
+WRITER_THREADS = 4  # 写入线程数
+WRITER_QUEUE_SIZE = 1000  # 等待写入的最多文件数，队列满时爬虫等待
+WRITER_BATCH_SIZE = 64  # 写入线程每批最多处理的文件数，开启 fsync 时每批同步一次文件夹
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)  # 秒，延迟直方图的分桶上限
 # VIEWER_FILE_TO_LOCAL = True  # 将viewer.html打开的文件替换为本地直接路径，不带viewer.html工具
 
 # 直接下载的其他文件格式
@@ -41,18 +99,169 @@ OTHER_SUFFIXES = set([
     'exe', 'ppt', 'pptx', 'm3u8', 'avi', 'wsf'
 ])
 MEDIA_SUFFIXES = set(['mp3', 'mp4', 'pdf', 'gz', 'tar', 'zip', 'rar', 'wav', 'm3u8', 'avi'])
+# 作为页面处理的后缀，开启 HEAD 探测时其他未知后缀的链接先探测类型
+PAGE_SUFFIXES = set(['html', 'htm', 'shtml', 'xhtml', 'php', 'asp', 'aspx', 'jsp', 'css'])
+# 链接队列的通道，按优先级排列：页面、小文件、大文件
+LANES = ('page', 'asset', 'media')
 # 域名名称
 DOMAIN_NAME = set(['com', 'cn', 'net', 'org', 'gov', 'io'])
-# html 内容里的链接匹配
-HTML_PATTERN = re.compile(r'(href|src)=(\"|\')([^\"\']*)')
-# css 内容里的链接匹配
-CSS_PATTERN = re.compile(r'url\((\"|\')([^\"\']*)')
+# html、css 内容里的链接匹配：html 标签(属性再由 ATTR_PATTERN 逐个匹配)、url() 及 @import；
+# 只在标签里匹配属性，不会匹配到脚本里的 location.href = u 等代码
+LINK_PATTERN = re.compile(
+    r'<[a-zA-Z][^\s/>]*(?P<attrs>(?:"[^"]*"|\'[^\']*\'|[^\'">])*)'
+    r'|url\(\s*(?:"(?P<url_dq>[^"]*)"|\'(?P<url_sq>[^\']*)\'|(?P<url_uq>[^\s"\')]+))'
+    r'|@import\s+(?:"(?P<import_dq>[^"]*)"|\'(?P<import_sq>[^\']*)\')',
+    re.I
+)
+# 标签里的属性，属性名前有空白；无引号的值到空白、'>'、引号或反引号为止，可以包含'='
+ATTR_PATTERN = re.compile(
+    r'\s(?P<name>[^\s"\'>/=]+)(?:\s*=\s*(?:"(?P<dq>[^"]*)"|\'(?P<sq>[^\']*)\'|(?P<uq>[^\s"\'>`]+)))?'
+)
+# srcset 属性里每个候选图片的链接
+SRCSET_PATTERN = re.compile(r'(?:^|,)\s*([^\s,]+)')
+# html 的 <meta charset>、<meta http-equiv> 及 css 的 @charset 声明的编码
+CHARSET_PATTERN = re.compile(
+    rb'<meta[^>]+charset\s*=\s*["\']?\s*([\w.:-]+)|^@charset\s+["\']([\w.:-]+)["\']', re.I
+)
+CHARSET_SNIFF_SIZE = 4096  # 字节，在内容开头查找编码声明的范围
+# 内容开头的 BOM 及对应编码
+CHARSET_BOMS = [(codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')]
+# 没有声明编码或声明的编码解码失败时依次尝试，gbk 包含 gb2312 且编码相同
+FALLBACK_CHARSETS = ['utf-8', 'gbk']
+# 很多服务器默认声明的单字节编码，总能解码成功，放在 utf-8 之后尝试
+WEAK_CHARSETS = set(['iso8859-1', 'cp1252'])
+# HLS 播放列表标签里的链接，如 #EXT-X-KEY、#EXT-X-MAP、#EXT-X-MEDIA 的 URI 属性
+HLS_URI_PATTERN = re.compile(r'URI="([^"]+)"')
+# 各 scheme 的默认端口，规范化链接时去掉
+DEFAULT_PORTS = {'http': PORT, 'https': 443}
+# 规范化链接时去掉的跟踪参数，支持通配符
+TRACKING_PARAMS = ['utm_*', 'gclid', 'fbclid', 'msclkid', 'yclid', 'mc_cid', 'mc_eid', '_ga']
+# 百分号编码，及编码时不需要转义的字符(RFC 3986 unreserved)
+ESCAPE_PATTERN = re.compile(r'%([0-9A-Fa-f]{2})')
+UNRESERVED_CHARS = set('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+# 断点续传响应的内容范围
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+# 条件请求返回304时，表示链接内容未修改
+NOT_MODIFIED = object()
+# HEAD 探测后链接移到其他通道，本次处理不算完成
+DEFERRED = object()
 
 
-def init_opener():
-    cookie = cookiejar.CookieJar()
+class PooledResponse(client.HTTPResponse):
+    '''
+    内容读完后把连接放回连接池，未读完就关闭的连接不再复用
+    '''
+    release = None
+
+    def _close_conn(self):
+        client.HTTPResponse._close_conn(self)
+        if self.release is not None:
+            release, self.release = self.release, None
+            release(not self.will_close)
+
+    def close(self):
+        # 内容未读完，连接里还有剩余数据
+        if self.fp is not None:
+            self.will_close = True
+        client.HTTPResponse.close(self)
+
+
+class KeepAliveHandler(request.HTTPHandler, request.HTTPSHandler):
+    '''
+    替代 urllib 默认的 HTTP/HTTPS 处理器，按 host 复用 keep-alive 连接，所有爬虫线程共用；
+    与 HTTPCookieProcessor 一起使用时 cookie 照常处理。
+
+    参数：
+        pool_size:  int,    每个host保持的空闲连接数。
+
+    例子：
+        handler = KeepAliveHandler(32)
+        opener = request.build_opener(handler)
+        content = opener.open('http://www.daorenjia.com').read()
+    '''
+
+    def __init__(self, pool_size=POOL_SIZE):
+        request.AbstractHTTPHandler.__init__(self)
+        self.pool_size = pool_size
+        self.idle_conns = {}
+        self.lock = threading.Lock()
+
+    def http_open(self, req):
+        return self.pooled_open(client.HTTPConnection, req)
+
+    def https_open(self, req):
+        return self.pooled_open(client.HTTPSConnection, req)
+
+    def get_conn(self, key):
+        with self.lock:
+            conns = self.idle_conns.get(key)
+            if conns:
+                return conns.pop()
+        return None
+
+    def put_conn(self, key, conn):
+        with self.lock:
+            conns = self.idle_conns.setdefault(key, [])
+            if len(conns) < self.pool_size:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def pooled_open(self, conn_class, req):
+        if not req.host:
+            raise URLError('no host given')
+        # 经代理的 https 请求，连接到代理后用 CONNECT 建立到目标 host 的隧道，按隧道的目标区分连接
+        key = (req.type, req.host, req._tunnel_host)
+        timeout = req.timeout
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items() if k not in headers)
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), val) for name, val in headers.items())
+        # 与 urllib 的 do_open 相同，Proxy-Authorization 只发给代理，不发给目标服务器
+        tunnel_headers = {}
+        if req._tunnel_host and 'Proxy-Authorization' in headers:
+            tunnel_headers['Proxy-Authorization'] = headers.pop('Proxy-Authorization')
+
+        # 复用的空闲连接可能已被服务器关闭，此时换新连接重试一次
+        while True:
+            conn = self.get_conn(key)
+            reused = conn is not None
+            if conn is None:
+                conn = conn_class(req.host, timeout=timeout)
+                conn.response_class = PooledResponse
+                if req._tunnel_host:
+                    conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+            else:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+            try:
+                conn.request(req.get_method(), req.selector, req.data, headers)
+                res = conn.getresponse()
+                break
+            except OSError as e:
+                conn.close()
+                if not reused:
+                    raise URLError(e)
+            except client.HTTPException:
+                conn.close()
+                if not reused:
+                    raise
+
+        res.release = lambda reusable: self.put_conn(key, conn) if reusable else conn.close()
+        res.url = req.get_full_url()
+        res.msg = res.reason
+        # 没有内容的响应(如304)直接读完，连接放回连接池
+        if res.length == 0:
+            res.read()
+        return res
+
+
+def init_opener(cookie, pool):
     cookie_support = request.HTTPCookieProcessor(cookie)
-    return request.build_opener(cookie_support)
+    return request.build_opener(cookie_support, pool)
 
 
 # 使能控制台及文件打印日志
@@ -61,7 +270,9 @@ def init_logger():
     logger.setLevel(logging.INFO)
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)
-    file_handler = logging.FileHandler('log.log', mode='w', encoding='utf-8')
+    # 页面处理子进程重新导入时不清空主进程的日志
+    file_mode = 'a' if multiprocessing.parent_process() else 'w'
+    file_handler = logging.FileHandler('log.log', mode=file_mode, encoding='utf-8')
     file_handler.setLevel(logging.NOTSET)
     formatter = logging.Formatter('%(asctime)s[%(levelname)s] %(message)s')
     console_handler.setFormatter(formatter)
@@ -71,7 +282,9 @@ def init_logger():
     return logger
 
 
-opener = init_opener()
+cookie = cookiejar.CookieJar()
+connection_pool = KeepAliveHandler()
+opener = init_opener(cookie, connection_pool)
 logger = init_logger()
 
 # 忽略证书验证
@@ -83,406 +296,2720 @@ else:
     ssl._create_default_https_context = _create_unverified_https_context
 
 
-class Spider(threading.Thread):
+class HostState(object):
+    '''
+    单个host的令牌桶、并发信号量、退避暂停时间、连续限流次数及出错统计
+    '''
+
+    def __init__(self, rate, concurrency):
+        self.rate = rate or None
+        self.base_rate = self.rate
+        self.tokens = 1
+        self.stamp = time.time()
+        self.blocked_until = 0
+        # 连续的 429/503 响应数，请求成功后清零
+        self.throttled = 0
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.media_semaphore = threading.BoundedSemaphore(max(1, int(concurrency * HOST_MEDIA_RATIO)))
+        self.window_start = self.stamp
+        self.requests = 0
+        self.errors = 0
+
+
+class HostScheduler(object):
     '''
-    爬虫线程，从爬虫管理器的链接队列获取链接，然后进行处理，保存链接文件，为主管理器提供新链接。
+    按 host 调度请求：令牌桶限制每秒请求数，信号量限制线程模式的并发数，大文件通道最多占用其中的 HOST_MEDIA_RATIO；
+    失败重试按指数退避加随机抖动等待，429/503 响应带 Retry-After 时按其暂停整个 host，
+    不带时只有失败的链接退避，连续 HOST_PAUSE_ERRORS 次才暂停整个 host；
+    每个统计窗口内出错比例过高时请求速率减半，恢复正常后逐步提高到设定值。
 
     参数：
-        queue:      Queue,  主管理器的链接队列；
-        home_dir:   str,    网站保存的文件home路径；
-        netloc:     str,    网站点，用于判断链接是否同一网站。
+        rate:           float,  每个host每秒最多请求数，0为不限制；
+        concurrency:    int,    线程模式下每个host的并发请求数。
 
     例子：
-        url = 'http://www.daorenjia.com'
-        url_parse = urlparse(url)
-        home_dir = "{}-site/".format(url_parse.netloc)
-        netloc = url_parse.netloc
-
-        s = Spider(None, home_dir, netloc)
-        f = s.handle_html('http://www.daorenjia.com/daozang11-408')
-        logger.info(f)
+        scheduler = HostScheduler(rate=5, concurrency=8)
+        with scheduler.request(link):
+            content = opener.open(link).read()
+        scheduler.record(link)
     '''
 
-    def __init__(self, queue, home_dir, netloc):
-        threading.Thread.__init__(self)
-        self.daemon = True
-        self.queue = queue
-        self.links = []
-        self.running = False
-        self.working = False
-        self.text_code = 'utf-8'
-        self.home_dir = home_dir
-        self.netloc = netloc
-        self.error_links = set()
+    def __init__(self, rate=HOST_RATE, concurrency=THREAD_NUM):
+        self.rate = rate
+        self.concurrency = concurrency
+        self.hosts = {}
+        self.lock = threading.Lock()
 
-    def get_res(self, link):
+    def get_host(self, link):
+        netloc = urlparse(link).netloc
+        with self.lock:
+            if netloc not in self.hosts:
+                self.hosts[netloc] = HostState(self.rate, self.concurrency)
+            return self.hosts[netloc]
+
+    def set_rate(self, link, rate):
         '''
-        获取 html 、 css 链接的响应
+        设置链接所在 host 的请求速率，如 robots.txt 的 Crawl-delay
         '''
-        socket.setdefaulttimeout(SOCKET_DEFAULT_TIMEOUT)
-        num_tries = 0
-        # 多次尝试获取
-        while num_tries < MAX_TRY:
-            try:
-                res = opener.open(Request(link)).read()
-                break
-            except Exception as e:
-                num_tries += 1
-                logger.warning('[{}]\t {} retry{}'.format(repr(e), link, num_tries))
+        host = self.get_host(link)
+        with self.lock:
+            host.rate = host.base_rate = rate
 
-        if num_tries >= MAX_TRY:
-            logger.error('[failed get]\t{0}'.format(link))
-            self.error_links.add(link)
-            return None
-        # 解码响应内容
-        try:
-            text = res.decode('utf-8')
-            self.text_code = 'utf-8'
-            return text
-        except UnicodeDecodeError:
-            pass
-        try:
-            text = res.decode('gb2312')
-            self.text_code = 'gb2312'
-            return text
-        except UnicodeDecodeError:
-            pass
-        try:
-            text = res.decode('gbk')
-            self.text_code = 'gbk'
-            return text
-        except UnicodeDecodeError:
-            pass
-        self.text_code = None
-        logger.warning('[UnicodeDecodeError]\t{0}'.format(link))
-        return None
+    def reserve(self, link):
+        '''
+        预约一次请求，返回需要等待的秒数
+        '''
+        host = self.get_host(link)
+        with self.lock:
+            now = time.time()
+            wait = max(0, host.blocked_until - now)
+            if host.rate is not None:
+                # 令牌可以为负数，表示已被预约的请求
+                host.tokens = min(1, host.tokens + (now - host.stamp) * host.rate) - 1
+                host.stamp = now
+                if host.tokens < 0:
+                    wait = max(wait, -host.tokens / host.rate)
+            return wait
 
-    def is_valid_link(self, link):
+    @contextlib.contextmanager
+    def request(self, link, lane=None):
         '''
-        检测有效链接
-        嵌入的 data:image 图片不作为新链接，且过滤非本网站的链接
+        线程模式下占用host的并发数，并等待到预约的请求时间；大文件通道的链接先占用大文件的并发数
         '''
-        if link.find('javascript:') >= 0 or link.find('@') >= 0 or link.find('data:image') >= 0:
-            return False
-        if link.find('http') >= 0:
-            netloc = urlparse(link).netloc
-            if netloc:
-                if netloc.find(':{}'.format(PORT)) > 0:
-                    netloc = netloc.replace(':{}'.format(PORT), '')
-                # return netloc[netloc.find('.') + 1:] == self.netloc[self.netloc.find('.') + 1:]
-                return netloc == self.netloc
+        host = self.get_host(link)
+        media = host.media_semaphore if lane == 'media' else contextlib.nullcontext()
+        with media, host.semaphore:
+            wait = self.reserve(link)
+            if wait > 0:
+                time.sleep(wait)
+            yield
+
+    def is_retryable(self, error):
+        '''
+        4xx 错误(超时及限流除外)重试也不会成功
+        '''
+        if isinstance(error, HTTPError):
+            return not (400 <= error.code < 500 and error.code not in (408, 425, 429))
         return True
 
-    def handle_valid_link(self, link):
-        link = parse.unquote(link)
-        link = link.replace('\\', '/')
+    def record(self, link, error=None):
+        '''
+        记录请求结果，窗口结束时按出错比例调整请求速率
+        '''
+        host = self.get_host(link)
+        with self.lock:
+            host.requests += 1
+            if error is None:
+                host.throttled = 0
+            elif self.is_retryable(error):
+                host.errors += 1
+            elapsed = time.time() - host.window_start
+            if elapsed >= RATE_WINDOW:
+                self.adjust_rate(link, host, elapsed)
 
-        # 转换viewer file文件路径为下载路径
-        link = self.get_viewer_file_link(link)
-        return link
+    def adjust_rate(self, link, host, elapsed):
+        error_rate = host.errors / host.requests
+        if error_rate > ERROR_RATE_THRESHOLD:
+            current = host.rate or host.requests / elapsed
+            if host.base_rate is None:
+                host.base_rate = current
+            host.rate = max(MIN_HOST_RATE, current / 2)
+            host.tokens = min(host.tokens, 0)
+            logger.warning('[{}] error rate {:.0%}, rate reduce to {:.2f}/s'.format(
+                urlparse(link).netloc, error_rate, host.rate))
+        elif host.rate is not None and host.rate < host.base_rate and error_rate < ERROR_RATE_THRESHOLD / 2:
+            host.rate = min(host.base_rate, host.rate * 1.5)
+            if host.rate >= host.base_rate and not self.rate:
+                # 未设定速率时恢复为不限制
+                host.rate = None
+                host.base_rate = None
+            logger.info('[{}] rate increase to {}/s'.format(urlparse(link).netloc, host.rate))
+        host.window_start = time.time()
+        host.requests = 0
+        host.errors = 0
 
-    def save_link_file(self, link, content):
-        # 获取本地路径
-        filepath = self.make_filepath(link)
-        # 保存文件
-        if os.path.exists(filepath):
-            logger.info('Existed\t{}'.format(filepath))
+    def get_retry_after(self, error):
+        value = error.headers.get('Retry-After') if isinstance(error, HTTPError) and error.headers else None
+        if not value:
+            return None
+        if value.strip().isdigit():
+            seconds = int(value)
         else:
-            with open(filepath, 'w', encoding=self.text_code) as fp:
-                fp.write(content)
-                logger.info('Saved\t{}'.format(filepath))
-        logger.info('Handled\t{}'.format(link))
-
-    def make_filepath(self, link):
-        '''
-        把链接创建为本地网站文件夹的绝对路径
-        '''
-        # 需要的话创建新文件夹
-        abs_filepath = self.get_abs_filepath(link)
-        dirname = os.path.dirname(abs_filepath)
-        if not os.path.exists(dirname):
             try:
-                os.makedirs(dirname)
-            except FileExistsError:
-                pass
-            except NotADirectoryError:
-                logger.error('[NotADirectoryError]\t{0}\t{1}'.format(link, abs_filepath))
-        return abs_filepath
+                seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+        return min(RETRY_AFTER_MAX, max(0, seconds))
 
-    def encode_link(self, link):
+    def backoff(self, link, num_tries, error=None):
         '''
-        为link编码，方便本地保存相对路径及本地网页跳转
+        返回第 num_tries 次失败后的等待秒数；429/503 带 Retry-After 或连续出现时同时暂停整个host，
+        偶发的 429/503 只让失败的链接退避
         '''
-        link = parse.unquote(link)
-        link = parse.quote(link)
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (num_tries - 1))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        if isinstance(error, HTTPError) and error.code in (429, 503):
+            retry_after = self.get_retry_after(error)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            host = self.get_host(link)
+            with self.lock:
+                host.throttled += 1
+                if retry_after is not None or host.throttled >= HOST_PAUSE_ERRORS:
+                    host.blocked_until = max(host.blocked_until, time.time() + delay)
+        return delay
 
-        # # ['+', ' ', '/', '?', '%', '#', '&', '=']
-        # codes = ['%2B', '%20', '%2F', '%3F', '%25', '%23', '%26', '%3D']
 
-        # ['+', ' ', '?', '%', '&', '=']
-        codes = ['%2B', '%20', '%3F', '%25', '%26', '%3D']
-        # insert '-', as '%2B' to '%2-B'
-        for c in codes:
-            if c in link:
-                link = link.replace(c, c[:2] + '-' + c[2])
+# 所有爬虫共用的 host 请求调度
+scheduler = HostScheduler()
 
-        link = parse.unquote(link)
-        return link
 
-    def decode_line(self, link):
-        codes = ['%2-B', '%2-0', '%2-F', '%3-F', '%2-5', '%2-3', '%2-6', '%3-D']
-        # remove nsert '-', as '%2-B' to '%2B'
-        for c in codes:
-            if c in link:
-                link = link.replace(c, c[:2] + c[-1])
-        return link
+class LRUCache(object):
+    '''
+    线程安全的 LRU 缓存，超过容量时淘汰最久未使用的项，记录命中及未命中次数。
 
-    def get_abs_filepath(self, link):
+    参数：
+        maxsize:    int,    最大条数。
+
+    例子：
+        cache = LRUCache(1000)
+        value = cache.get(key)
+        if value is None:
+            value = compute(key)
+            cache.put(key, value)
+        logger.info(cache.stats())
+    '''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
         '''
-        获取链接绝对路径
+        获取缓存的值，没有则返回 None
         '''
-        link = self.encode_link(link)
+        with self.lock:
+            value = self.data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.data.move_to_end(key)
+            return value
 
-        # 如果链接为非文件，则补上index.html
-        if link[-1] == '/':
-            link += 'index.html'
-        elif link.split('.')[-1] in DOMAIN_NAME:
-            link += '/index.html'
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
 
-        if ADD_HTML_SUFFIX:
-            # 如果没有文件后缀，或者非正常后缀带'%', 则补上'.html'
-            if link.split('/')[-1].find('.') < 0 or ('%' in link.split('/')[-1].split('.')[-1]):
-                link += '.html'
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses}
 
-        abs_filepath = os.path.join(self.home_dir, link[link.find('//') + 2:])
-        return abs_filepath
 
-    def replace_links(self, content, links, current_link):
-        curr_link_path = self.get_abs_filepath(current_link)
-        for link in set(links):
-            handled_link = self.handle_valid_link(link)
-            new_link = urljoin(current_link, handled_link)
-
-            # 如果带有#符号，将链接与#号分开，获取路径后再拼接
-            if '#' in new_link:
-                split = new_link.split('#')
-                vlink = split[0]
-                flag = split[1]
-                new_link_path = self.get_abs_filepath(vlink)
-                new_link_path += '#{}'.format(flag)
-            else:
-                new_link_path = self.get_abs_filepath(new_link)
+# 所有爬虫共用的链接本地路径缓存，及页面里链接的相对路径缓存
+path_cache = LRUCache(PATH_CACHE_SIZE)
+rel_link_cache = LRUCache(PATH_CACHE_SIZE)
+# 已创建的文件夹缓存，不再重复检查是否存在
+dir_cache = LRUCache(PATH_CACHE_SIZE)
 
-            rel_link = os.path.relpath(new_link_path, os.path.dirname(curr_link_path))
-            rel_link = rel_link.replace('\\', '/')
 
-            # 保留使用viewer.html工具打开文件
-            # if (not VIEWER_FILE_TO_LOCAL) and self.is_viewer_file_link(link):
-            #     rel_link = self.get_viewer_file_rellink(rel_link)
+def make_dirs(dirname):
+    '''
+    需要的话创建文件夹，已创建的文件夹记入缓存
+    '''
+    if not dirname or dir_cache.get(dirname):
+        return
+    try:
+        os.makedirs(dirname, exist_ok=True)
+    except FileExistsError:
+        # 同名文件已存在
+        raise NotADirectoryError(dirname)
+    dir_cache.put(dirname, True)
 
-            replacement = '"{}"'.format(rel_link)
-            content = content.replace(
-                '"{}"'.format(link), replacement
-            ).replace('\'{}\''.format(link), replacement)
-        return content
 
-    def handle_html(self, link):
-        # 获取链接文本
-        text = self.get_res(link)
-        if text is None:
-            return []
-        # 提取文本中的链接
-        raw_links = set([_[2] for _ in HTML_PATTERN.findall(text)])
-        raw_links = raw_links.union([_[1] for _ in CSS_PATTERN.findall(text)])
-        handled_links = []
-        if raw_links:
-            # 提取有效的链接
-            valid_links = list(filter(self.is_valid_link, raw_links))
-            # 对有效的链接进行处理
-            handled_links = list(map(self.handle_valid_link, valid_links))
-            # 替换 text 内容里的链接为本地网站文件夹里的相对路径
-            text = self.replace_links(text, valid_links, link)
-        # 保存 text 文件
-        self.save_link_file(link, text)
+def sync_dir(dirname):
+    '''
+    把文件夹的改动(新建、重命名的文件)同步到磁盘，不支持的系统忽略
+    '''
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
 
-        # 获取有效的链接供主线程爬虫管理器获取
-        links = set([urljoin(link, t_link) for t_link in handled_links])
-        return links
 
-    def get_viewer_file_link(self, link):
-        '''
-        如果是viewer链接，获取指定的文件路径
-        '''
-        link = parse.unquote(link)
-        if 'viewer.html?file=' in link:
-            link = link.split('viewer.html?file=')[-1]
-        return link
+class Histogram(object):
+    '''
+    延迟直方图，按 METRICS_BUCKETS 分桶计数，分位数取所在分桶的上限
+    '''
 
-    def is_viewer_file_link(self, link):
-        return 'viewer.html' in link
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
 
-    def get_viewer_file_rellink(self, link):
-        '''
-        获取viewer file的路径名
-        '''
-        ulink = parse.unquote(link)
-        if 'viewer.html?file=' in ulink:
-            # 相对与viewer的路径
-            link = ulink.split('viewer.html?file=')[0] + 'viewer.html?file=..' + ulink.split('viewer.html?file=')[1]
-        link = 'web/viewer.html?file={}'.format(link)
-        return link
+    def observe(self, value):
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
 
-    def is_pdf_valid(self, path):
-        state = True
-        try:
-            reader = PdfFileReader(path)
-            if reader.getNumPages() < 1:
-                state = False
-        except Exception:
-            state = False
-            logger.warning('{}, {}'.format(path, traceback.format_exc()))
-        return state
+    def quantile(self, q):
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(METRICS_BUCKETS, self.counts):
+            total += count
+            if total >= rank:
+                return min(bound, self.max)
+        return self.max
 
-    def download(self, link):
-        '''
-        直接下载链接文件
-        '''
-        socket.setdefaulttimeout(SOCKET_DEFAULT_TIMEOUT)
-        if link.split('.')[-1].lower() in MEDIA_SUFFIXES:
-            socket.setdefaulttimeout(SOCKET_DOWNLOAD_TIMEOUT)
-        num_tries = 0
-        # 多次尝试下载
-        while num_tries < MAX_TRY:
-            try:
-                file_path = self.make_filepath(link)
-
-                # 如果文件存在则不重新下载
-                if os.path.exists(file_path):
-                    # 判断PDF文件是否有效
-                    if not file_path.endswith('.pdf') or self.is_pdf_valid(file_path):
-                        logger.info('exists \t{0}'.format(link))
-                        return
-                urlretrieve(link, file_path)
-                break
-            except Exception as e:
-                num_tries += 1
-                logger.warning('[{}]\t {} retry{}'.format(repr(e), link, num_tries))
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'avg': round(self.sum / self.count, 6) if self.count else 0,
+            'max': round(self.max, 6),
+            'p50': round(self.quantile(0.5), 6),
+            'p90': round(self.quantile(0.9), 6),
+            'p99': round(self.quantile(0.99), 6),
+            'buckets': dict(zip([str(b) for b in METRICS_BUCKETS] + ['inf'], self.counts)),
+        }
 
-        if num_tries >= MAX_TRY:
-            logger.error('[failed download]\t{0}'.format(link))
-            self.error_links.add(link)
-        else:
-            logger.info('Downloaded\t{0}'.format(link))
 
-    def handle(self, link):
-        logger.info("{}, handle: {}".format(threading.current_thread().name, link))
-        links = []
+class Metrics(object):
+    '''
+    线程安全的爬取指标：计数器、各阶段(fetch/download/decode/rewrite/write/process/handle)的延迟直方图、
+    每个host进行中的请求数、队列深度等回调指标，以及每个爬虫线程处理链接的耗时与CPU时间，
+    CPU时间远小于耗时说明瓶颈在网络，接近则说明瓶颈在页面处理。
+    快照可定期写入 JSON 文件(MetricsReporter)，或由本地 HTTP 端点以文本提供(serve_metrics)。
 
-        # 获取链接类型
-        link_type = link.split('.')[-1].lower()
-        # 判断链接类型
-        if link_type in OTHER_SUFFIXES:
-            self.download(link)
-        else:
-            links = self.handle_html(link)
-        return links
+    例子：
+        metrics = Metrics()
+        with metrics.timer('fetch'):
+            content = opener.open(link).read()
+        metrics.incr('bytes', len(content))
+        logger.info(metrics.snapshot())
+    '''
 
-    def run(self):
-        logger.info('{} start.'.format(threading.current_thread().name))
-        self.running = True
-        self.working = True
-        while self.running:
-            try:
-                # 如果links不为空，则等待管理器获取
-                if len(self.links):
-                    logger.info('{} - links not empty, waiting...'.format(threading.current_thread().name))
-                    time.sleep(0.1)
-                    continue
+    def __init__(self):
+        self.start_time = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.inflight_hosts = {}
+        self.gauges = {}
+        self.workers = {}
+        self.last_bytes = (self.start_time, 0)
+        self.lock = threading.Lock()
 
-                # 从管理器queue获取link
-                link = self.queue.get(timeout=SPIDER_GET_LINK_TIMEOUT)
-                logger.info('{} - queue size: {}'.format(threading.current_thread().name, self.queue.qsize()))
-                self.working = True
-                # 处理link，得到links
-                self.links = set(self.handle(link))
-            except Empty:
-                self.working = False
-        logger.info('{} end.'.format(threading.current_thread().name))
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(seconds)
 
-    def is_working(self):
+    @contextlib.contextmanager
+    def timer(self, name):
         '''
-        提供管理器判断是否工作完成
+        记录代码块的耗时，出现异常也记录
         '''
-        return self.working
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
 
-    def close(self):
+    @contextlib.contextmanager
+    def inflight(self, link):
         '''
-        提供管理器退出爬虫线程
+        记录链接所在host进行中的请求数
         '''
-        self.running = False
+        netloc = urlparse(link).netloc
+        with self.lock:
+            self.inflight_hosts[netloc] = self.inflight_hosts.get(netloc, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.inflight_hosts[netloc] -= 1
 
-    def get_links(self):
+    def gauge(self, name, func):
         '''
-        提供管理器重新放入爬虫队列
+        注册快照时调用的指标，如队列深度
         '''
-        # 获取且清空links
-        links = self.links
-        self.links = []
-        return links
+        self.gauges[name] = func
 
-    def get_error_links(self):
+    def handled(self, worker, seconds, cpu=None):
         '''
-        提供主线程爬虫管理器再次放入爬虫链接队列
+        Spider.handle 的计时钩子，记录处理一个链接的耗时及线程CPU时间
         '''
-        export_links = self.error_links.copy()
-        self.error_links.clear()
-        return export_links
+        self.observe('handle', seconds)
+        with self.lock:
+            stats = self.workers.setdefault(worker, {'links': 0, 'seconds': 0.0, 'cpu': 0.0})
+            stats['links'] += 1
+            stats['seconds'] += seconds
+            stats['cpu'] += cpu or 0
 
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict((name, h.snapshot()) for name, h in self.histograms.items())
+            inflight = dict((host, num) for host, num in self.inflight_hosts.items() if num)
+            workers = dict((name, dict(stats)) for name, stats in self.workers.items())
+            # 距上次快照的下载速度
+            last_time, last_bytes = self.last_bytes
+            self.last_bytes = (now, counters.get('bytes', 0))
+        for stats in workers.values():
+            stats['cpu_ratio'] = round(stats['cpu'] / stats['seconds'], 3) if stats['seconds'] else 0
+        uptime = now - self.start_time
+        return {
+            'time': now,
+            'uptime': round(uptime, 3),
+            'process_cpu': round(time.process_time(), 3),
+            'bytes_per_sec': round(counters.get('bytes', 0) / uptime, 1) if uptime else 0,
+            'recent_bytes_per_sec': round((counters.get('bytes', 0) - last_bytes) / (now - last_time), 1)
+            if now > last_time else 0,
+            'counters': counters,
+            'gauges': dict((name, func()) for name, func in list(self.gauges.items())),
+            'inflight': inflight,
+            'histograms': histograms,
+            'workers': workers,
+            'caches': {'path': path_cache.stats(), 'rel_link': rel_link_cache.stats()},
+        }
 
-class Manager(object):
+    def text(self):
+        '''
+        以每行'名称{标签} 数值'的文本格式输出快照
+        '''
+        snapshot = self.snapshot()
+        lines = []
+        for name in ('uptime', 'process_cpu', 'bytes_per_sec', 'recent_bytes_per_sec'):
+            lines.append('{} {}'.format(name, snapshot[name]))
+        for group in ('counters', 'gauges'):
+            for name, value in sorted(snapshot[group].items()):
+                lines.append('{} {}'.format(name, value))
+        for host, num in sorted(snapshot['inflight'].items()):
+            lines.append('inflight{{host="{}"}} {}'.format(host, num))
+        for name, hist in sorted(snapshot['histograms'].items()):
+            for key in ('count', 'sum', 'avg', 'max'):
+                lines.append('{}_seconds_{} {}'.format(name, key, hist[key]))
+            for key, quantile in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+                lines.append('{}_seconds{{quantile="{}"}} {}'.format(name, quantile, hist[key]))
+        for worker, stats in sorted(snapshot['workers'].items()):
+            for key, value in sorted(stats.items()):
+                lines.append('worker_{}{{worker="{}"}} {}'.format(key, worker, value))
+        for cache, stats in sorted(snapshot['caches'].items()):
+            for key, value in sorted(stats.items()):
+                lines.append('cache_{}{{cache="{}"}} {}'.format(key, cache, value))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        '''
+        把快照写入 JSON 文件，先写临时文件再替换，读取方不会读到一半的内容
+        '''
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fp:
+            json.dump(self.snapshot(), fp, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    def summary(self):
+        '''
+        结束时打印的简要统计：计数器及各阶段的次数、平均耗时
+        '''
+        snapshot = self.snapshot()
+        stages = ', '.join('{}: {}/{:.3f}s'.format(name, hist['count'], hist['avg'])
+                           for name, hist in sorted(snapshot['histograms'].items()))
+        return '{}, {:.0f} B/s, {}'.format(snapshot['counters'], snapshot['bytes_per_sec'], stages)
+
+
+# 所有爬虫共用的爬取指标
+metrics = Metrics()
+
+
+class MetricsReporter(threading.Thread):
     '''
-    爬虫主管理器，开启爬虫线程，提供链接队列于爬虫线程获取，遍历爬虫线程收取新链接，然后提交到队列。
+    后台线程，每隔 interval 秒把指标快照写入 JSON 文件，关闭时再写入最终快照。
 
     参数：
-        url:    str,    网站地址，格式如为'http://www.xxx.com'.
+        path:       str,    JSON 文件路径；
+        interval:   float,  写入间隔秒数。
 
     例子：
-        url = 'http://www.daorenjia.com'
-        m = Manager(url)
-        m.start()
-
+        reporter = MetricsReporter('metrics.json')
+        reporter.start()
+        reporter.close()
     '''
 
-    def __init__(self, url):
-        self.url = url.replace('\\', '/')
-        self.links = set()
-        self.queue = Queue()
-        self.spiders = []
+    def __init__(self, path, interval=METRICS_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
 
-    def is_valid_link(self, link):
-        '''
-        判断是否url下的链接
-        '''
-        # if link.find('http') >= 0:
-        #     netloc = urlparse(link).netloc
-        #     if netloc:
-        #         if netloc.find(':{}'.format(PORT)) > 0:
-        #             netloc = netloc.replace(':{}'.format(PORT), '')
-        #         # return netloc[netloc.find('.') + 1:] == self.netloc[self.netloc.find('.') + 1:]
-        #         return netloc == self.netloc
-        return self.url in link
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                metrics.dump(self.path)
+            except OSError:
+                logger.warning('{}, {}'.format(self.path, traceback.format_exc()))
 
-    def handle_link(self, link):
+    def close(self):
+        self.stopped.set()
+        self.join()
+        metrics.dump(self.path)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    '''
+    本地指标端点，GET 任意路径返回文本格式的快照，'/json' 返回 JSON
+    '''
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/json':
+            body = json.dumps(metrics.snapshot(), ensure_ascii=False).encode('utf-8')
+            content_type = 'application/json; charset=utf-8'
+        else:
+            body = metrics.text().encode('utf-8')
+            content_type = 'text/plain; charset=utf-8'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port, host='127.0.0.1'):
+    '''
+    在后台线程启动本地指标端点，返回 server，结束时调用 server.shutdown()
+    '''
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info('metrics endpoint: http://{}:{}/'.format(host, server.server_port))
+    return server
+
+
+class PartFile(object):
+    '''
+    下载临时文件'<文件>.part'，分块写入并计算内容哈希。已有部分内容时用 Range 请求续传，
+    完成后校验长度，再原子地重命名为目标文件，中断或失败不会留下不完整的目标文件。
+
+    参数：
+        file_path:  str,    下载的目标文件路径；
+        part_path:  str,    临时文件路径，默认为'<文件>.part'。
+
+    例子：
+        part = PartFile(file_path)
+        res = opener.open(Request(link, headers=part.range_headers()))
+        shutil.copyfileobj(res, part.open(res.status, res.headers))
+        digest = part.commit()
+    '''
+
+    def __init__(self, file_path, part_path=None):
+        self.file_path = file_path
+        self.part_path = part_path or file_path + '.part'
+        self.offset = os.path.getsize(self.part_path) if os.path.exists(self.part_path) else 0
+        self.length = None
+        self.size = 0
+        self.fp = None
+        self.status = None
+        self.headers = None
+        self.hash = hashlib.sha1()
+
+    def range_headers(self):
+        if self.offset:
+            return {'Range': 'bytes={}-'.format(self.offset)}
+        return {}
+
+    def open(self, status, headers):
+        '''
+        按响应打开临时文件：206 且起始位置一致则追加，否则从头写入
+        '''
+        self.status, self.headers = status, headers
+        if status == 206:
+            match = CONTENT_RANGE_PATTERN.match(headers.get('Content-Range', ''))
+            if not match or int(match.group(1)) != self.offset:
+                self.discard()
+                raise ContentTooShortError('unexpected Content-Range: {}'.format(headers.get('Content-Range')), None)
+            if match.group(3) != '*':
+                self.length = int(match.group(3))
+            # 已下载的部分计入哈希
+            with open(self.part_path, 'rb') as fp:
+                for data in iter(lambda: fp.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    self.hash.update(data)
+            self.size = self.offset
+            self.fp = open(self.part_path, 'ab')
+            logger.info('Resume\t{} from {}'.format(self.file_path, self.offset))
+        else:
+            length = headers.get('Content-Length')
+            self.length = int(length) if length is not None else None
+            self.offset = 0
+            self.fp = open(self.part_path, 'wb')
+        return self
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.fp.write(data)
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+
+    def discard(self):
+        '''
+        删除无法续传的临时文件
+        '''
+        self.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+    def verify(self):
+        '''
+        关闭临时文件并校验长度，返回内容哈希；内容不完整时抛出 ContentTooShortError
+        '''
+        self.close()
+        if self.length is not None and self.size != self.length:
+            if self.size > self.length:
+                self.discard()
+            raise ContentTooShortError(
+                'retrieval incomplete: got only {} out of {} bytes'.format(self.size, self.length), None
+            )
+        return self.hash.hexdigest()
+
+    def commit(self, link=None, blob_store=None):
+        '''
+        校验长度后重命名为目标文件，返回内容哈希；有 blob_store 时存入内容寻址存储再链接为目标文件
+        '''
+        digest = self.verify()
+        if blob_store is not None:
+            blob_store.put(link, digest, self.part_path, self.file_path)
+        else:
+            os.replace(self.part_path, self.file_path)
+        return digest
+
+
+class FileWriter(object):
+    '''
+    文件写入线程，爬虫把页面内容放入有界队列后立即返回，由写入线程创建文件夹、写入临时文件再原子地重命名；
+    队列满时放入会等待，以此限制爬虫速度，不在爬虫里做磁盘操作。
+    开启 fsync 时每批文件写完后逐个同步到磁盘再重命名，最后每个文件夹同步一次。
+    放入时可带回调，文件重命名(及同步)完成后以 True 调用，写入失败以 False 调用，用于此时才记录链接完成。
+
+    参数：
+        threads:    int,    写入线程数；
+        queue_size: int,    等待写入的最多文件数；
+        fsync:      bool,   重命名前把文件同步到磁盘。
+
+    例子：
+        writer = FileWriter(4, 1000)
+        writer.put(file_path, b'<html></html>', callback=lambda ok: logger.info(ok))
+        writer.close()  # 等待全部文件写入完成
+    '''
+
+    def __init__(self, threads=WRITER_THREADS, queue_size=WRITER_QUEUE_SIZE, fsync=False):
+        self.queue_size = queue_size
+        self.fsync = fsync
+        self.queue = deque()
+        # 已放入但未写完的文件数
+        self.pending = 0
+        self.running = True
+        self.cond = threading.Condition()
+        self.threads = [
+            threading.Thread(target=self.run, name='Writer-{}'.format(i), daemon=True) for i in range(threads)
+        ]
+        [thread.start() for thread in self.threads]
+        metrics.gauge('write_queue', lambda: len(self.queue))
+
+    def put(self, file_path, data, overwrite=True, callback=None):
+        '''
+        放入要写入的文件内容，队列满时等待；overwrite 为 False 时不覆盖已存在的文件；
+        callback 在写入线程里以是否写入成功调用
+        '''
+        with self.cond:
+            while len(self.queue) >= self.queue_size:
+                self.cond.wait()
+            self.queue.append((file_path, data, overwrite, callback))
+            self.pending += 1
+            self.cond.notify_all()
+
+    def take(self):
+        '''
+        取出一批文件，队列为空时等待，关闭后返回空列表
+        '''
+        with self.cond:
+            while not self.queue and self.running:
+                self.cond.wait()
+            batch = [self.queue.popleft() for i in range(min(len(self.queue), WRITER_BATCH_SIZE))]
+            # 唤醒等待队列空位的爬虫
+            self.cond.notify_all()
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.take()
+            if not batch:
+                return
+            try:
+                with metrics.timer('disk'):
+                    self.write_batch(batch)
+            except Exception:
+                logger.error(traceback.format_exc())
+            finally:
+                with self.cond:
+                    self.pending -= len(batch)
+                    self.cond.notify_all()
+
+    def write_batch(self, batch):
+        '''
+        写入一批临时文件，需要时同步到磁盘，再重命名为目标文件，最后调用各文件的回调
+        '''
+        written = []
+        # 已落盘的文件的回调，需在文件夹同步之后调用
+        done = []
+        for file_path, data, overwrite, callback in batch:
+            if not overwrite and os.path.exists(file_path):
+                logger.info('Existed\t{}'.format(file_path))
+                done.append(callback)
+                continue
+            # 临时文件名带线程号，同一文件同时写入时互不影响
+            tmp_path = '{}.{}.tmp'.format(file_path, threading.get_ident())
+            fp = None
+            try:
+                make_dirs(os.path.dirname(file_path))
+                fp = open(tmp_path, 'wb')
+                fp.write(data)
+            except Exception as e:
+                self.discard(fp, tmp_path)
+                logger.error('[{}]\t{}'.format(repr(e), file_path))
+                metrics.incr('write_errors')
+                self.notify(callback, False)
+                continue
+            written.append((fp, tmp_path, file_path, callback))
+        dirs = set()
+        for fp, tmp_path, file_path, callback in written:
+            try:
+                if self.fsync:
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                fp.close()
+                os.replace(tmp_path, file_path)
+            except OSError as e:
+                self.discard(fp, tmp_path)
+                logger.error('[{}]\t{}'.format(repr(e), file_path))
+                metrics.incr('write_errors')
+                self.notify(callback, False)
+                continue
+            dirs.add(os.path.dirname(file_path))
+            done.append(callback)
+            logger.info('Saved\t{}'.format(file_path))
+        if self.fsync:
+            [sync_dir(dirname) for dirname in dirs]
+        [self.notify(callback, True) for callback in done]
+
+    def notify(self, callback, ok):
+        if callback is None:
+            return
+        try:
+            callback(ok)
+        except Exception:
+            logger.error(traceback.format_exc())
+
+    def discard(self, fp, tmp_path):
+        '''
+        写入失败时关闭并删除临时文件，不留下写了一半的文件
+        '''
+        try:
+            if fp is not None:
+                fp.close()
+        except OSError:
+            pass
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    def flush(self):
+        '''
+        等待已放入的文件全部写完
+        '''
+        with self.cond:
+            while self.pending:
+                self.cond.wait()
+
+    def close(self):
+        self.flush()
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        [thread.join() for thread in self.threads]
+
+
+class BlobStore(object):
+    '''
+    内容寻址存储，相同内容的下载文件只保留一份'<目录>/<哈希前2位>/<哈希>'，
+    再硬链接到 make_filepath 计算的路径，不支持硬链接(如跨文件系统)时复制；
+    manifest.tsv 逐行记录链接及内容哈希，同一链接以最后一行为准。
+    硬链接的文件共用数据，不能在原处修改。
+
+    参数：
+        root:   str,    存储目录，默认放在网站home目录旁边，如'www.xxx.com-site-blobs'。
+
+    例子：
+        store = BlobStore('www.daorenjia.com-site-blobs')
+        digest = part.commit(link, store)
+        store.close()
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self.manifest = open(os.path.join(root, 'manifest.tsv'), 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def get_blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, link, digest, src_path, file_path):
+        '''
+        把下载完成的临时文件存入，内容已存在则删除临时文件，再链接为目标文件
+        '''
+        blob_path = self.get_blob_path(digest)
+        if os.path.exists(blob_path):
+            os.remove(src_path)
+            metrics.incr('dedup_hits')
+            metrics.incr('dedup_bytes', os.path.getsize(blob_path))
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(src_path, blob_path)
+        self.link(blob_path, file_path)
+        if link is not None:
+            with self.lock:
+                self.manifest.write('{}\t{}\n'.format(link, digest))
+                self.manifest.flush()
+
+    def link(self, blob_path, file_path):
+        # 先链接到临时路径再替换，已有的目标文件不会出现缺失
+        tmp_path = file_path + '.link'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(blob_path, tmp_path)
+        except OSError:
+            shutil.copyfile(blob_path, tmp_path)
+        os.replace(tmp_path, file_path)
+
+    def load_manifest(self):
+        '''
+        读取链接到内容哈希的对应关系
+        '''
+        with self.lock:
+            self.manifest.flush()
+        manifest = {}
+        with open(os.path.join(self.root, 'manifest.tsv'), encoding='utf-8') as fp:
+            for line in fp:
+                link, _, digest = line.rstrip('\n').rpartition('\t')
+                if link:
+                    manifest[link] = digest
+        return manifest
+
+    def close(self):
+        with self.lock:
+            self.manifest.close()
+
+
+class ArchiveStore(object):
+    '''
+    归档存储，页面及下载文件不再逐个保存为小文件，而是按顺序追加到滚动的 WARC、tar 或 zip 归档文件里；
+    归档不压缩，index.jsonl 逐行记录本地路径、链接、所在归档文件、内容的偏移及大小，可按偏移随机读取，
+    或用 extract_archive 还原为与直接保存相同的目录结构。同一路径以最后一行为准。
+    WARC 记录里包含响应头，tar、zip 的响应头记录在索引里。下载的临时文件放在'<目录>/parts'，支持续传。
+
+    参数：
+        root:       str,    归档目录，默认放在网站home目录旁边，如'www.xxx.com-site-archive'；
+        kind:       str,    归档格式，'warc'、'tar' 或 'zip'；
+        max_size:   int,    归档文件超过此字节数后换新文件。
+
+    例子：
+        store = ArchiveStore('www.daorenjia.com-site-archive', 'warc')
+        store.write(link, file_path, b'<html></html>', headers)
+        store.close()
+        extract_archive('www.daorenjia.com-site-archive')
+    '''
+    KINDS = ('warc', 'tar', 'zip')
+
+    def __init__(self, root, kind='warc', max_size=ARCHIVE_MAX_SIZE):
+        if kind not in self.KINDS:
+            raise ValueError('unknown archive kind: {}'.format(kind))
+        self.root = root
+        self.kind = kind
+        self.max_size = max_size
+        os.makedirs(os.path.join(root, 'parts'), exist_ok=True)
+        self.index_path = os.path.join(root, 'index.jsonl')
+        # 内存里只保留本地路径及大小，完整的记录只在索引文件里
+        self.sizes = {}
+        if os.path.exists(self.index_path):
+            for entry in read_archive_index(root):
+                self.sizes[entry['path']] = entry['size']
+        self.index = open(self.index_path, 'a', encoding='utf-8')
+        # 续爬时不修改已有的归档文件，从下一个编号开始
+        self.number = len([name for name in os.listdir(root) if name.split('.')[-1] in self.KINDS])
+        self.name = None
+        self.fp = None
+        self.archive = None
+        self.lock = threading.Lock()
+
+    def has(self, file_path):
+        return file_path in self.sizes
+
+    def get_size(self, file_path):
+        return self.sizes[file_path]
+
+    def get_part_path(self, file_path):
+        '''
+        下载的临时文件路径，按本地路径的哈希命名，不创建网站目录
+        '''
+        return os.path.join(self.root, 'parts', hashlib.sha1(file_path.encode('utf-8')).hexdigest() + '.part')
+
+    def open_archive(self):
+        self.name = '{:05d}.{}'.format(self.number, self.kind)
+        self.number += 1
+        path = os.path.join(self.root, self.name)
+        if self.kind == 'tar':
+            self.archive = tarfile.open(path, 'w', format=tarfile.PAX_FORMAT)
+            self.fp = self.archive.fileobj
+        elif self.kind == 'zip':
+            self.archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+            self.fp = self.archive.fp
+        else:
+            self.fp = open(path, 'wb')
+            self.write_warc_record('warcinfo', None, 'application/warc-fields',
+                                   'software: website_downloader\r\nformat: WARC/1.0\r\n'.encode('utf-8'))
+        logger.info('Archive\t{}'.format(path))
+
+    def close_archive(self):
+        if self.archive is not None:
+            self.archive.close()
+        elif self.fp is not None:
+            self.fp.close()
+        self.archive = self.fp = None
+
+    def write_warc_record(self, record_type, link, content_type, block, fp=None, size=0):
+        '''
+        写入一条 WARC 记录，内容为 block 及 fp 里的 size 字节，返回 fp 内容在归档文件里的偏移
+        '''
+        lines = [
+            'WARC/1.0',
+            'WARC-Type: {}'.format(record_type),
+            'WARC-Record-ID: <urn:uuid:{}>'.format(uuid.uuid4()),
+            'WARC-Date: {}'.format(time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+        ]
+        if link is not None:
+            lines.append('WARC-Target-URI: {}'.format(link))
+        lines += ['Content-Type: {}'.format(content_type), 'Content-Length: {}'.format(len(block) + size)]
+        self.fp.write(('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8') + block)
+        offset = self.fp.tell()
+        if fp is not None:
+            shutil.copyfileobj(fp, self.fp, DOWNLOAD_CHUNK_SIZE)
+        self.fp.write(b'\r\n\r\n')
+        return offset
+
+    def add(self, link, file_path, fp, size, status=200, headers=None):
+        '''
+        把 fp 里 size 字节的内容追加到当前归档文件，并写入索引
+        '''
+        headers = [(k, v) for k, v in (headers.items() if headers is not None else [])
+                   if k.lower() not in ('content-length', 'transfer-encoding', 'connection')]
+        with self.lock:
+            if self.fp is None:
+                self.open_archive()
+            if self.kind == 'warc':
+                # 内容已解码及替换链接，响应头里的长度按实际内容
+                lines = ['HTTP/1.1 {} {}'.format(status, client.responses.get(status, ''))]
+                lines += ['{}: {}'.format(k, v) for k, v in headers] + ['Content-Length: {}'.format(size)]
+                block = ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8', 'replace')
+                offset = self.write_warc_record('response', link, 'application/http; msgtype=response', block, fp,
+                                                size)
+            elif self.kind == 'tar':
+                info = tarfile.TarInfo(file_path)
+                info.size = size
+                info.mtime = time.time()
+                self.archive.addfile(info, fp)
+                # addfile 写入的是 info 的副本，按补齐到块大小的内容长度往回推算内容偏移
+                offset = self.archive.offset - -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            else:
+                with self.archive.open(zipfile.ZipInfo(file_path, time.localtime()[:6]), 'w',
+                                       force_zip64=size >= 0xFFFFFFFF) as dest:
+                    offset = self.fp.tell()
+                    shutil.copyfileobj(fp, dest, DOWNLOAD_CHUNK_SIZE)
+            entry = {'path': file_path, 'link': link, 'archive': self.name, 'offset': offset, 'size': size,
+                     'status': status}
+            if self.kind != 'warc':
+                entry['headers'] = dict(headers)
+            self.sizes[file_path] = size
+            self.index.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.index.flush()
+            if self.fp.tell() >= self.max_size:
+                self.close_archive()
+        logger.info('Archived\t{}'.format(file_path))
+
+    def write(self, link, file_path, data, headers=None):
+        '''
+        追加页面内容
+        '''
+        self.add(link, file_path, io.BytesIO(data), len(data), 200, headers)
+
+    def put_part(self, link, part):
+        '''
+        校验下载完成的临时文件，追加到归档后删除，返回内容哈希
+        '''
+        digest = part.verify()
+        with open(part.part_path, 'rb') as fp:
+            self.add(link, part.file_path, fp, part.size, 200 if part.status == 206 else part.status, part.headers)
+        os.remove(part.part_path)
+        return digest
+
+    def close(self):
+        with self.lock:
+            self.close_archive()
+            self.index.close()
+
+
+def read_archive_index(root):
+    '''
+    按顺序读取归档索引的记录
+    '''
+    with open(os.path.join(root, 'index.jsonl'), encoding='utf-8') as fp:
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
+
+
+def open_archive_entry(root, entry):
+    '''
+    按偏移打开归档里的一条内容，返回定位到内容开头的文件对象，内容为 entry['size'] 字节
+    '''
+    fp = open(os.path.join(root, entry['archive']), 'rb')
+    fp.seek(entry['offset'])
+    return fp
+
+
+def extract_archive(root, dest='.'):
+    '''
+    把归档还原为与直接保存相同的目录结构，同一路径取最后的记录，返回还原的文件数
+    '''
+    entries = dict((entry['path'], entry) for entry in read_archive_index(root))
+    for entry in entries.values():
+        file_path = os.path.join(dest, entry['path'])
+        make_dirs(os.path.dirname(file_path))
+        with open_archive_entry(root, entry) as src, open(file_path + '.part', 'wb') as fp:
+            size = entry['size']
+            while size > 0:
+                data = src.read(min(size, DOWNLOAD_CHUNK_SIZE))
+                if not data:
+                    raise ContentTooShortError('archive truncated: {}'.format(entry['path']), None)
+                fp.write(data)
+                size -= len(data)
+        os.replace(file_path + '.part', file_path)
+    logger.info('extracted {} files from {}'.format(len(entries), root))
+    return len(entries)
+
+
+class CrawlState(object):
+    '''
+    爬取状态，用 sqlite 记录每个链接的状态(queued/done/failed)，供中断后续爬；
+    同时记录每个资源的 ETag、Last-Modified、内容哈希及页面链接，供增量更新使用；
+    以及本地PDF文件的校验结果(按文件大小及修改时间判断是否过期)，两者在清空状态时保留。
+    状态先缓存，按 STATE_COMMIT_INTERVAL 批量写入，同一线程内的写入顺序不变。
+
+    参数：
+        path:   str,    数据库文件路径，默认放在网站home目录旁边，如'www.xxx.com-site.db'。
+
+    例子：
+        state = CrawlState('www.daorenjia.com-site.db')
+        state.add('http://www.daorenjia.com')
+        state.set('http://www.daorenjia.com', 'done')
+        state.close()
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS links (url TEXT PRIMARY KEY, status TEXT)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS resources '
+            '(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, digest TEXT, links TEXT)'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS pdf_checks '
+            '(path TEXT PRIMARY KEY, url TEXT, size INTEGER, mtime INTEGER, status TEXT)'
+        )
+        self.conn.commit()
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_links = set()
+        self.commit_time = time.time()
+
+    def add(self, link):
+        '''
+        记录新链接，已记录的链接不变
+        '''
+        with self.lock:
+            self.pending_links.add(link)
+        self.write('INSERT OR IGNORE INTO links VALUES (?, ?)', (link, 'queued'))
+
+    def has_link(self, link):
+        '''
+        链接是否已记录，包括尚未写入数据库的链接
+        '''
+        with self.lock:
+            if link in self.pending_links:
+                return True
+            return self.conn.execute('SELECT 1 FROM links WHERE url = ?', (link,)).fetchone() is not None
+
+    def set(self, link, status):
+        self.write('INSERT OR REPLACE INTO links VALUES (?, ?)', (link, status))
+
+    def get_meta(self, link):
+        '''
+        获取资源信息，没有记录返回 None
+        '''
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT etag, last_modified, digest, links FROM resources WHERE url = ?', (link,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            'etag': row[0],
+            'last_modified': row[1],
+            'digest': row[2],
+            'links': row[3].split('\n') if row[3] else [],
+        }
+
+    def set_meta(self, link, etag, last_modified, digest, links=None):
+        self.write(
+            'INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?)',
+            (link, etag, last_modified, digest, '\n'.join(links) if links else None)
+        )
+
+    def get_check(self, path):
+        '''
+        获取PDF文件的校验记录 (size, mtime, status)，没有记录返回 None
+        '''
+        with self.lock:
+            return self.conn.execute(
+                'SELECT size, mtime, status FROM pdf_checks WHERE path = ?', (path,)
+            ).fetchone()
+
+    def set_check(self, path, link, size, mtime, status):
+        self.write('INSERT OR REPLACE INTO pdf_checks VALUES (?, ?, ?, ?, ?)', (path, link, size, mtime, status))
+
+    def checks(self, status):
+        '''
+        获取指定校验状态的PDF文件路径及链接
+        '''
+        with self.lock:
+            self.commit()
+            return self.conn.execute('SELECT path, url FROM pdf_checks WHERE status = ?', (status,)).fetchall()
+
+    def write(self, sql, args):
+        with self.lock:
+            self.pending.append((sql, args))
+            if time.time() - self.commit_time >= STATE_COMMIT_INTERVAL:
+                self.commit()
+
+    def commit(self):
+        for sql, args in self.pending:
+            self.conn.execute(sql, args)
+        self.conn.commit()
+        self.pending = []
+        self.pending_links.clear()
+        self.commit_time = time.time()
+
+    def links(self):
+        '''
+        遍历已记录的链接及状态
+        '''
+        with self.lock:
+            self.commit()
+        return self.conn.execute('SELECT url, status FROM links')
+
+    def clear(self):
+        with self.lock:
+            self.pending = []
+            self.pending_links.clear()
+            self.conn.execute('DELETE FROM links')
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.conn.close()
+
+
+def fingerprint(link):
+    '''
+    链接的64位指纹，0 留作空位
+    '''
+    digest = hashlib.blake2b(link.encode('utf-8', 'surrogatepass'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+class FingerprintSet(object):
+    '''
+    已发现链接的集合，只保存链接的64位指纹，用开放寻址哈希表存放在 array 里，每个链接约占16字节；
+    数百万链接时指纹冲突的概率可以忽略。
+
+    参数：
+        capacity:   int,    初始容量，超过一半时翻倍。
+
+    例子：
+        seen = FingerprintSet()
+        seen.add('http://www.daorenjia.com')  # 新链接返回 True
+        seen.add('http://www.daorenjia.com')  # 已存在返回 False
+    '''
+
+    def __init__(self, capacity=1024):
+        size = 1
+        while size < capacity * 2:
+            size *= 2
+        self.table = array('Q', bytes(8 * size))
+        self.mask = size - 1
+        self.count = 0
+
+    def insert(self, table, mask, fp):
+        i = fp & mask
+        while table[i]:
+            if table[i] == fp:
+                return False
+            i = (i + 1) & mask
+        table[i] = fp
+        return True
+
+    def add(self, link):
+        '''
+        加入链接，新链接返回 True，已存在返回 False
+        '''
+        if not self.insert(self.table, self.mask, fingerprint(link)):
+            return False
+        self.count += 1
+        if self.count * 2 > len(self.table):
+            self.grow()
+        return True
+
+    def grow(self):
+        table = array('Q', bytes(16 * len(self.table)))
+        mask = len(table) - 1
+        for fp in self.table:
+            if fp:
+                self.insert(table, mask, fp)
+        self.table, self.mask = table, mask
+
+    def __contains__(self, link):
+        fp = fingerprint(link)
+        i = fp & self.mask
+        while self.table[i]:
+            if self.table[i] == fp:
+                return True
+            i = (i + 1) & self.mask
+        return False
+
+    def __len__(self):
+        return self.count
+
+
+class BloomSeen(object):
+    '''
+    已发现链接的布隆过滤器，内存固定(默认1000万链接约12MB)；过滤器判断已存在时，
+    再到爬取状态数据库里精确确认，误判不会丢失链接。
+
+    参数：
+        state:      CrawlState, 爬取状态，记录全部链接；
+        capacity:   int,        预计链接数；
+        error_rate: float,      误判率。
+
+    例子：
+        seen = BloomSeen(CrawlState('www.daorenjia.com-site.db'))
+        if seen.add(link):
+            state.add(link)
+    '''
+
+    def __init__(self, state, capacity=SEEN_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+        self.state = state
+        self.num_bits = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, link):
+        digest = hashlib.blake2b(link.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, link):
+        '''
+        加入链接，新链接返回 True，已存在返回 False；需在同一把锁内把新链接记录到爬取状态
+        '''
+        positions = self.positions(link)
+        if all(self.bits[p >> 3] & (1 << (p & 7)) for p in positions):
+            if self.state.has_link(link):
+                return False
+            metrics.incr('bloom_false_positives')
+        for p in positions:
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+        return True
+
+    def __contains__(self, link):
+        positions = self.positions(link)
+        if not all(self.bits[p >> 3] & (1 << (p & 7)) for p in positions):
+            return False
+        return self.state.has_link(link)
+
+    def __len__(self):
+        return self.count
+
+
+def normalize_escapes(part, safe):
+    '''
+    统一百分号编码：不需要转义的字符解码，其余编码转为大写，未编码的中文、空格等字符按 utf-8 编码
+    '''
+    part = ESCAPE_PATTERN.sub(
+        lambda m: chr(int(m.group(1), 16)) if chr(int(m.group(1), 16)) in UNRESERVED_CHARS else m.group(0).upper(), part
+    )
+    return parse.quote(part, safe=safe + '%')
+
+
+def remove_dot_segments(path):
+    '''
+    解析路径里的 '.'、'..'，如 '/a/./b/../' 为 '/a/'
+    '''
+    segments = path.split('/')
+    output = []
+    for segment in segments:
+        if segment == '.':
+            continue
+        if segment == '..':
+            # 保留绝对路径开头的空段
+            if len(output) > 1:
+                output.pop()
+            continue
+        output.append(segment)
+    # 以 '.'、'..' 结尾的路径是文件夹
+    if segments[-1] in ('.', '..'):
+        output.append('')
+    return '/'.join(output)
+
+
+class LinkCanonicalizer(object):
+    '''
+    链接规范化，去重及本地路径都使用规范化后的链接，相同资源的不同写法只爬取一次：
+    scheme、host 转小写，去掉默认端口，解析路径里的 '.'、'..'，统一百分号编码，
+    去掉跟踪参数并按参数名排序，去掉#号后的部分。
+
+    参数：
+        drop_params:    list,   去掉的查询参数名，支持通配符，为空则不去掉。
+
+    例子：
+        canonicalizer = LinkCanonicalizer(['utm_*'])
+        canonicalizer.canonicalize('HTTP://Example.com:80/a/./b/../c?b=2&a=1&utm_source=x#top')
+        # 'http://example.com/a/c?a=1&b=2'
+    '''
+
+    def __init__(self, drop_params=TRACKING_PARAMS):
+        self.set_drop_params(drop_params)
+
+    def set_drop_params(self, drop_params):
+        self.drop_params = list(drop_params)
+        self.drop_pattern = None
+        if self.drop_params:
+            self.drop_pattern = re.compile('|'.join(fnmatch.translate(name) for name in self.drop_params), re.I)
+
+    def is_dropped(self, param):
+        if self.drop_pattern is None:
+            return False
+        return self.drop_pattern.match(parse.unquote_plus(param.split('=')[0])) is not None
+
+    def canonicalize(self, link):
+        scheme, netloc, path, query, fragment = parse.urlsplit(link.strip())
+        scheme = scheme.lower()
+        if netloc:
+            userinfo, at, hostport = netloc.rpartition('@')
+            host, colon, port = hostport.lower().rpartition(':')
+            # 没有端口，或为 IPv6 地址里的冒号
+            if not colon or ']' in port:
+                host, port = hostport.lower(), ''
+            if port and port != str(DEFAULT_PORTS.get(scheme)):
+                host += ':' + port
+            netloc = userinfo + at + host
+        path = remove_dot_segments(normalize_escapes(path, "/:@!$&'()*+,;="))
+        if netloc and not path:
+            path = '/'
+        params = [normalize_escapes(param, "=:@!$'()*+,;/?") for param in query.split('&') if param]
+        params = [param for param in params if not self.is_dropped(param)]
+        # 按参数名排序，同名参数保持原顺序
+        params.sort(key=lambda param: param.split('=')[0])
+        return parse.urlunsplit((scheme, netloc, path, '&'.join(params), ''))
+
+
+# 所有爬虫共用的链接规范化
+canonicalizer = LinkCanonicalizer()
+
+
+def is_playlist_link(link):
+    return parse.urlsplit(link).path.lower().endswith('.m3u8')
+
+
+def find_playlist_uris(text):
+    '''
+    依次返回 HLS 播放列表里链接的起止位置、链接，以及是否为子播放列表；
+    #EXT-X-STREAM-INF 下一行的各码率播放列表、#EXT-X-MEDIA 的其他音轨等为子播放列表，其余为分片、密钥等文件
+    '''
+    pos = 0
+    stream_inf = False
+    for line in text.splitlines(True):
+        stripped = line.strip()
+        if stripped.startswith('#'):
+            is_playlist = stripped.startswith(('#EXT-X-MEDIA:', '#EXT-X-I-FRAME-STREAM-INF'))
+            for match in HLS_URI_PATTERN.finditer(line):
+                yield pos + match.start(1), pos + match.end(1), match.group(1), is_playlist
+            stream_inf = stripped.startswith('#EXT-X-STREAM-INF')
+        elif stripped:
+            start = pos + line.find(stripped)
+            yield start, start + len(stripped), stripped, stream_inf or is_playlist_link(stripped)
+            stream_inf = False
+        pos += len(line)
+
+
+def link_lane(link):
+    '''
+    按后缀把链接分到通道：大文件(MEDIA_SUFFIXES)、小文件(其他 OTHER_SUFFIXES)，其余为页面(html、css等)
+    '''
+    link_type = link.split('.')[-1].lower()
+    if link_type in MEDIA_SUFFIXES:
+        return 'media'
+    if link_type in OTHER_SUFFIXES:
+        return 'asset'
+    return 'page'
+
+
+def response_lane(headers):
+    '''
+    按 HEAD 响应头分通道：文本为页面，其他按 Content-Length 分为小文件或大文件
+    '''
+    content_type = headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if not content_type or content_type.startswith('text/') or content_type == 'application/xhtml+xml':
+        return 'page'
+    length = headers.get('Content-Length', '')
+    if length.isdigit() and int(length) >= LARGE_FILE_SIZE:
+        return 'media'
+    return 'asset'
+
+
+class Frontier(object):
+    '''
+    爬虫链接队列，线程安全，放入时对链接去重；以未完成链接数判断爬取是否结束，不需要轮询爬虫线程状态。
+    链接按类型分为页面、小文件、大文件三个通道(LANES)，按优先级取出，每个通道内先进先出(即按发现的深度)；
+    页面通道有链接等待或处理中时，小文件、大文件通道最多占用 budgets 个爬虫，为新发现的页面留出爬虫；页面爬完后不限制。
+
+    参数：
+        handle_link:    function,   放入前对链接的处理，如去掉#号；
+        is_valid_link:  function,   判断链接是否需要爬取；
+        state:          CrawlState, 爬取状态，为空则不记录；
+        seen:           FingerprintSet, 已发现链接的集合，默认 FingerprintSet，可换为 BloomSeen；
+        head_probe:     bool,       后缀未知的链接先用 HEAD 请求探测类型。
+
+    例子：
+        frontier = Frontier(lambda link: link, lambda link: True)
+        frontier.put('http://www.daorenjia.com')
+        link = frontier.get()  # 全部链接完成后返回 None
+        frontier.task_done(link)
+    '''
+
+    def __init__(self, handle_link, is_valid_link, state=None, seen=None, head_probe=False):
+        self.handle_link = handle_link
+        self.is_valid_link = is_valid_link
+        self.state = state
+        self.seen = seen if seen is not None else FingerprintSet()
+        self.head_probe = head_probe
+        self.queues = dict((lane, deque()) for lane in LANES)
+        self.active = dict((lane, 0) for lane in LANES)
+        self.budgets = dict((lane, None) for lane in LANES)
+        # 探测后改变通道的链接
+        self.lanes = {}
+        self.unfinished = 0
+        self.cond = threading.Condition()
+
+    def get_lane(self, link):
+        return self.lanes.get(link) or link_lane(link)
+
+    def set_workers(self, num):
+        '''
+        按爬虫数设置小文件、大文件通道最多占用的爬虫数
+        '''
+        with self.cond:
+            self.budgets['asset'] = max(1, int(num * ASSET_WORKER_RATIO))
+            self.budgets['media'] = max(1, int(num * MEDIA_WORKER_RATIO))
+
+    def needs_probe(self, link):
+        '''
+        开启探测时，后缀未知的链接需要先探测类型；没有后缀的链接按页面处理
+        '''
+        if not self.head_probe or link in self.lanes:
+            return False
+        suffix = os.path.splitext(parse.urlsplit(link).path)[1][1:].lower()
+        return bool(suffix) and suffix not in PAGE_SUFFIXES and suffix not in OTHER_SUFFIXES
+
+    def put(self, link):
+        '''
+        放入新链接，已存在或无效的链接返回 False
+        '''
+        link = self.handle_link(link)
+        if not self.is_valid_link(link):
+            return False
+        with self.cond:
+            if not self.seen.add(link):
+                return False
+            # 在锁内记录，BloomSeen 确认时可以查到
+            if self.state:
+                self.state.add(link)
+            self.unfinished += 1
+            self.queues[self.get_lane(link)].append(link)
+            self.cond.notify()
+        return True
+
+    def retry(self, links):
+        '''
+        重新放入失败的链接，不做去重
+        '''
+        with self.cond:
+            for link in links:
+                self.unfinished += 1
+                self.queues[self.get_lane(link)].append(link)
+            self.cond.notify_all()
+        if self.state:
+            [self.state.set(link, 'queued') for link in links]
+
+    def defer(self, link, lane):
+        '''
+        把正在处理的链接移到探测出的通道，本次处理不调用 task_done
+        '''
+        with self.cond:
+            self.active[self.get_lane(link)] -= 1
+            self.lanes[link] = lane
+            self.queues[lane].append(link)
+            self.cond.notify_all()
+
+    def load_state(self):
+        '''
+        从爬取状态恢复链接，未完成及失败的链接重新放入队列，返回放入的链接数
+        '''
+        num = 0
+        with self.cond:
+            for link, status in self.state.links():
+                self.seen.add(link)
+                if status != 'done':
+                    self.unfinished += 1
+                    self.queues[self.get_lane(link)].append(link)
+                    num += 1
+            self.cond.notify_all()
+        return num
+
+    def pick(self):
+        '''
+        按优先级取出链接：通道占用的爬虫未超过限制，或页面通道已空闲
+        '''
+        pages_busy = self.queues['page'] or self.active['page']
+        for lane in LANES:
+            queue = self.queues[lane]
+            if not queue:
+                continue
+            budget = self.budgets[lane]
+            if budget is None or self.active[lane] < budget or not pages_busy:
+                self.active[lane] += 1
+                return queue.popleft()
+        return None
+
+    def pop(self):
+        '''
+        不阻塞地取出链接，没有可取的链接返回 None
+        '''
+        with self.cond:
+            return self.pick()
+
+    def get(self):
+        '''
+        阻塞地取出链接，所有链接完成后返回 None
+        '''
+        with self.cond:
+            while True:
+                link = self.pick()
+                if link is not None:
+                    return link
+                if self.unfinished == 0:
+                    return None
+                self.cond.wait()
+
+    def task_done(self, link, failed=False, record=True):
+        '''
+        链接处理完成，新链接需在此之前放入；record 为 False 时不记录爬取状态，由写入线程写完文件后记录
+        '''
+        if self.state and record:
+            self.state.set(link, 'failed' if failed else 'done')
+        with self.cond:
+            self.active[self.get_lane(link)] -= 1
+            self.lanes.pop(link, None)
+            self.unfinished -= 1
+            if self.unfinished == 0:
+                self.cond.notify_all()
+            elif self.qsize():
+                # 通道占用的爬虫减少，唤醒等待的爬虫
+                self.cond.notify()
+
+    def is_finished(self):
+        return self.unfinished == 0
+
+    def join(self):
+        with self.cond:
+            while self.unfinished:
+                self.cond.wait()
+
+    def qsize(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+
+def parse_sitemap(fp):
+    '''
+    流式解析 sitemap 或 sitemap 索引，gzip 压缩的自动解压，依次返回 (是否为索引, 链接)；
+    解析完的元素随即清除，大文件不占用内存
+    '''
+    fp = io.BufferedReader(fp)
+    if fp.peek(2)[:2] == b'\x1f\x8b':
+        fp = gzip.GzipFile(fileobj=fp)
+    is_index = None
+    for event, elem in iterparse(fp, events=('start', 'end')):
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if event == 'start':
+            if is_index is None:
+                is_index = tag == 'sitemapindex'
+            continue
+        if tag == 'loc' and elem.text and elem.text.strip():
+            yield is_index, elem.text.strip()
+        elif tag in ('url', 'sitemap'):
+            elem.clear()
+
+
+class LinkGraph(object):
+    '''
+    链接图导出，每处理完一个链接追加一行 JSON：链接、状态(HTTP状态码或'exists'/'failed')、大小、内容类型、
+    最后修改时间，页面还包括其中的链接；边爬边写，不占用内存，结束后可由 export_sitemap 生成 sitemap。
+
+    参数：
+        path:   str,    JSON lines 文件路径；
+        append: bool,   续爬时追加到已有文件。
+
+    例子：
+        graph = LinkGraph('www.daorenjia.com-graph.jsonl')
+        graph.write('http://www.daorenjia.com/', 200, headers, len(content), links)
+        graph.close()
+    '''
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.fp = open(path, 'a' if append else 'w', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def write(self, link, status, headers=None, size=None, links=None):
+        record = {'url': link, 'status': status}
+        if size is not None:
+            record['size'] = size
+        if headers is not None:
+            record['type'] = headers.get('Content-Type')
+            if headers.get('Last-Modified'):
+                record['last_modified'] = headers.get('Last-Modified')
+        if links is not None:
+            record['links'] = sorted(links)
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.fp.write(line)
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
+
+
+def export_sitemap(graph_path, sitemap_path, base_url):
+    '''
+    从链接图文件生成 sitemap，包括全部成功获取的链接；超过 SITEMAP_MAX_URLS 时拆分为多个文件，
+    sitemap_path 为引用它们的 sitemap 索引，索引里的地址相对于 base_url。逐行读取，用指纹去重，返回链接数
+    '''
+    root, ext = os.path.splitext(sitemap_path)
+    seen = FingerprintSet()
+    part_paths = []
+    fp = None
+    num = 0
+    with open(graph_path, encoding='utf-8') as graph:
+        for line in graph:
+            record = json.loads(line)
+            if record['status'] not in (200, 206, 304, 'exists') or not seen.add(record['url']):
+                continue
+            if num % SITEMAP_MAX_URLS == 0:
+                if fp is not None:
+                    fp.write('</urlset>\n')
+                    fp.close()
+                part_paths.append('{}-{}{}'.format(root, len(part_paths) + 1, ext))
+                fp = open(part_paths[-1], 'w', encoding='utf-8')
+                fp.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                         '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+            fp.write('<url><loc>{}</loc>'.format(escape(record['url'])))
+            if record.get('last_modified'):
+                try:
+                    lastmod = email.utils.parsedate_to_datetime(record['last_modified']).strftime('%Y-%m-%d')
+                    fp.write('<lastmod>{}</lastmod>'.format(lastmod))
+                except (TypeError, ValueError):
+                    pass
+            fp.write('</url>\n')
+            num += 1
+    if fp is None:
+        part_paths.append(sitemap_path)
+        fp = open(sitemap_path, 'w', encoding='utf-8')
+        fp.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+    fp.write('</urlset>\n')
+    fp.close()
+
+    if len(part_paths) == 1:
+        os.replace(part_paths[0], sitemap_path)
+    else:
+        with open(sitemap_path, 'w', encoding='utf-8') as fp:
+            fp.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                     '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+            for path in part_paths:
+                fp.write('<sitemap><loc>{}</loc></sitemap>\n'.format(
+                    escape(urljoin(base_url, os.path.basename(path)))))
+            fp.write('</sitemapindex>\n')
+    logger.info('sitemap: {} urls, {} files'.format(num, len(part_paths)))
+    return num
+
+
+def css_escape(error):
+    '''
+    编码错误处理：css 里编码不能表示的字符替换为 css 转义(如'\\4e2d ')，注册为'cssescape'
+    '''
+    chars = error.object[error.start:error.end]
+    return ''.join('\\{:x} '.format(ord(char)) for char in chars), error.end
+
+
+codecs.register_error('cssescape', css_escape)
+
+
+class Spider(threading.Thread):
+    '''
+    爬虫线程，从爬虫管理器的链接队列获取链接，然后进行处理，保存链接文件，把新链接直接放回链接队列。
+
+    参数：
+        queue:      Frontier,   主管理器的链接队列；
+        home_dir:   str,    网站保存的文件home路径；
+        netloc:     str,    网站点，用于判断链接是否同一网站；
+        state:      CrawlState, 爬取状态，记录资源信息；
+        update:     bool,   增量更新，已存在的文件发送条件请求，内容变化则覆盖；
+        page_pool:  PagePool,   页面处理进程池，为空则在本线程处理页面；
+        blob_store: BlobStore,  下载文件的内容寻址存储，为空则直接保存；
+        graph:      LinkGraph,  链接图导出，为空则不导出；
+        writer:     FileWriter, 页面文件的写入线程，为空则在本线程写入；
+        archive:    ArchiveStore,   归档存储，不为空则页面及下载文件追加到归档，不保存为单独的文件；
+        hls_pool:   ThreadPoolExecutor, 所有播放列表共用的分片下载线程池，为空则在本线程依次下载。
+
+    例子：
+        url = 'http://www.daorenjia.com'
+        url_parse = urlparse(url)
+        home_dir = "{}-site/".format(url_parse.netloc)
+        netloc = url_parse.netloc
+
+        s = Spider(None, home_dir, netloc)
+        f = s.handle_html('http://www.daorenjia.com/daozang11-408')
+        logger.info(f)
+    '''
+
+    def __init__(self, queue, home_dir, netloc, state=None, update=False, page_pool=None, blob_store=None,
+                 graph=None, writer=None, archive=None, hls_pool=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.running = False
+        self.home_dir = home_dir
+        self.netloc = netloc
+        self.state = state
+        self.update = update
+        self.page_pool = page_pool
+        self.blob_store = blob_store
+        self.graph = graph
+        self.writer = writer
+        self.archive = archive
+        self.hls_pool = hls_pool
+        self.error_links = set()
+        # 交给写入线程、写完后才记录完成的页面链接
+        self.pending_writes = set()
+
+    def get_res(self, link, meta=None):
+        '''
+        获取 html 、 css 链接的响应，返回内容及响应头；未修改返回 NOT_MODIFIED
+        '''
+        socket.setdefaulttimeout(SOCKET_DEFAULT_TIMEOUT)
+        headers = self.make_conditional_headers(meta)
+        num_tries = 0
+        # 多次尝试获取，失败后按退避时间等待
+        while True:
+            try:
+                with scheduler.request(link), metrics.inflight(link), metrics.timer('fetch'):
+                    res = opener.open(Request(link, headers=headers))
+                    content = res.read()
+                scheduler.record(link)
+                metrics.incr('requests')
+                metrics.incr('bytes', len(content))
+                break
+            except Exception as e:
+                if isinstance(e, HTTPError) and e.code == 304:
+                    scheduler.record(link)
+                    metrics.incr('requests')
+                    metrics.incr('not_modified')
+                    logger.info('Not modified\t{}'.format(link))
+                    return NOT_MODIFIED
+                num_tries += 1
+                logger.warning('[{}]\t {} retry{}'.format(repr(e), link, num_tries))
+                if not self.wait_retry(link, num_tries, e):
+                    logger.error('[failed get]\t{0}'.format(link))
+                    self.error_links.add(link)
+                    return None
+        return content, res.headers
+
+    def wait_retry(self, link, num_tries, error):
+        '''
+        记录失败，需要重试则按退避时间等待后返回 True
+        '''
+        scheduler.record(link, error)
+        if num_tries >= MAX_TRY or not scheduler.is_retryable(error):
+            metrics.incr('failed')
+            return False
+        metrics.incr('retries')
+        time.sleep(scheduler.backoff(link, num_tries, error))
+        return True
+
+    def get_meta(self, link):
+        '''
+        增量更新时，获取本地文件(归档时为归档里的记录)已存在的链接的资源信息
+        '''
+        if not self.update or self.state is None:
+            return None
+        file_path = self.get_abs_filepath(link)
+        if not (self.archive.has(file_path) if self.archive is not None else os.path.exists(file_path)):
+            return None
+        return self.state.get_meta(link)
+
+    def make_conditional_headers(self, meta):
+        headers = {}
+        if meta:
+            if meta['etag']:
+                headers['If-None-Match'] = meta['etag']
+            if meta['last_modified']:
+                headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def add_graph(self, link, status, headers=None, size=None, links=None):
+        '''
+        把链接的处理结果加入链接图
+        '''
+        if self.graph is not None:
+            self.graph.write(link, status, headers, size, links)
+
+    def save_meta(self, link, headers, digest, links=None):
+        '''
+        记录资源信息，供下次增量更新
+        '''
+        if self.state is not None:
+            self.state.set_meta(link, headers.get('ETag'), headers.get('Last-Modified'), digest, links)
+
+    def detect_charsets(self, res, charset=None):
+        '''
+        返回候选编码：BOM、响应头声明的编码、内容开头 <meta charset> 或 @charset 声明的编码，最后是 FALLBACK_CHARSETS
+        '''
+        declared = [name for bom, name in CHARSET_BOMS if res.startswith(bom)]
+        match = CHARSET_PATTERN.search(res, 0, CHARSET_SNIFF_SIZE)
+        for name in (charset, match and (match.group(1) or match.group(2)).decode('ascii')):
+            try:
+                declared.append(codecs.lookup(name).name)
+            except (LookupError, TypeError):
+                pass
+        charsets = [name for name in declared if name not in WEAK_CHARSETS]
+        charsets += FALLBACK_CHARSETS + [name for name in declared if name in WEAK_CHARSETS]
+        return list(OrderedDict.fromkeys(charsets))
+
+    def decode_res(self, link, res, charset=None):
+        '''
+        按候选编码解码响应内容，返回文本及编码，编码随页面保存文件使用；解码失败返回 (None, None)。
+        解码在第一个无效字节处停止，声明的编码正确时只解码一次
+        '''
+        for encoding in self.detect_charsets(res, charset):
+            try:
+                return res.decode(encoding), encoding
+            except UnicodeDecodeError:
+                pass
+        logger.warning('[UnicodeDecodeError]\t{0}'.format(link))
+        return None, None
+
+    def is_valid_link(self, link):
+        '''
+        检测有效链接
+        嵌入的 data:image 图片不作为新链接，且过滤非本网站的链接
+        '''
+        if link.find('javascript:') >= 0 or link.find('@') >= 0 or link.find('data:image') >= 0:
+            return False
+        if link.find('http') >= 0:
+            # 规范化后比较，host 大小写及默认端口不同的链接也属于本网站
+            netloc = urlparse(canonicalizer.canonicalize(link)).netloc
+            if netloc:
+                # return netloc[netloc.find('.') + 1:] == self.netloc[self.netloc.find('.') + 1:]
+                return netloc == self.netloc
+        return True
+
+    def handle_valid_link(self, link):
+        # html 属性里的'&'常写作'&amp;'
+        link = link.replace('&amp;', '&')
+        link = parse.unquote(link)
+        link = link.replace('\\', '/')
+
+        # 转换viewer file文件路径为下载路径
+        link = self.get_viewer_file_link(link)
+        return link
+
+    def encode_text(self, link, text, encoding):
+        '''
+        按页面的编码编码文本；替换后的本地路径可能有声明的编码(如 us-ascii)不能表示的字符，
+        html 用字符引用(&#20013;)、css 用转义(\\4e2d )表示，保持声明的编码，其他文本改用 utf-8
+        '''
+        try:
+            return text.encode(encoding)
+        except UnicodeEncodeError:
+            file_path = self.get_abs_filepath(link)
+            if file_path.endswith('.html'):
+                return text.encode(encoding, 'xmlcharrefreplace')
+            if file_path.endswith('.css'):
+                return text.encode(encoding, 'cssescape')
+            logger.warning('[UnicodeEncodeError]\t{} saved as utf-8'.format(link))
+            return text.encode('utf-8')
+
+    def save_link_file(self, link, content, encoding, headers=None):
+        '''
+        保存文本文件，content 为 bytes 时直接写入原始内容，否则按页面的编码编码后写入；
+        有写入线程时交给写入线程，不等待写入完成；有归档存储时连同响应头追加到归档
+        '''
+        if not isinstance(content, bytes):
+            content = self.encode_text(link, content, encoding)
+        if self.archive is not None:
+            file_path = self.get_abs_filepath(link)
+            if self.archive.has(file_path) and not self.update:
+                logger.info('Existed\t{}'.format(file_path))
+            else:
+                self.archive.write(link, file_path, content, headers)
+            return
+        if self.writer is not None:
+            # 增量更新时覆盖已存在的文件；文件写完后才记录链接完成，进程中断时未写入的页面续爬时重新下载
+            self.pending_writes.add(link)
+            self.writer.put(self.get_abs_filepath(link), content, self.update,
+                            lambda ok: self.write_done(link, ok))
+            return
+        # 获取本地路径
+        filepath = self.make_filepath(link)
+        # 保存文件，增量更新时覆盖
+        if os.path.exists(filepath) and not self.update:
+            logger.info('Existed\t{}'.format(filepath))
+        else:
+            with open(filepath, 'wb') as fp:
+                fp.write(content)
+                logger.info('Saved\t{}'.format(filepath))
+        logger.info('Handled\t{}'.format(link))
+
+    def write_done(self, link, ok):
+        '''
+        写入线程写完页面文件后记录链接状态，写入失败的链接记为失败，稍后重试
+        '''
+        if not ok:
+            self.error_links.add(link)
+        if self.state is not None:
+            self.state.set(link, 'done' if ok else 'failed')
+
+    def is_write_pending(self, link):
+        '''
+        链接的页面是否交给了写入线程，是则爬取状态由写入线程记录
+        '''
+        if link not in self.pending_writes:
+            return False
+        self.pending_writes.discard(link)
+        return True
+
+    def make_filepath(self, link):
+        '''
+        把链接创建为本地网站文件夹的绝对路径
+        '''
+        # 需要的话创建新文件夹，已创建的文件夹不再检查
+        abs_filepath = self.get_abs_filepath(link)
+        try:
+            make_dirs(os.path.dirname(abs_filepath))
+        except NotADirectoryError:
+            logger.error('[NotADirectoryError]\t{0}\t{1}'.format(link, abs_filepath))
+        return abs_filepath
+
+    def encode_link(self, link):
+        '''
+        为link编码，方便本地保存相对路径及本地网页跳转
+        '''
+        link = parse.unquote(link)
+        link = parse.quote(link)
+
+        # # ['+', ' ', '/', '?', '%', '#', '&', '=']
+        # codes = ['%2B', '%20', '%2F', '%3F', '%25', '%23', '%26', '%3D']
+
+        # ['+', ' ', '?', '%', '&', '=']
+        codes = ['%2B', '%20', '%3F', '%25', '%26', '%3D']
+        # insert '-', as '%2B' to '%2-B'
+        for c in codes:
+            if c in link:
+                link = link.replace(c, c[:2] + '-' + c[2])
+
+        link = parse.unquote(link)
+        return link
+
+    def decode_line(self, link):
+        codes = ['%2-B', '%2-0', '%2-F', '%3-F', '%2-5', '%2-3', '%2-6', '%3-D']
+        # remove nsert '-', as '%2-B' to '%2B'
+        for c in codes:
+            if c in link:
+                link = link.replace(c, c[:2] + c[-1])
+        return link
+
+    def get_abs_filepath(self, link):
+        '''
+        获取链接绝对路径，结果缓存供其他页面重复使用
+        '''
+        key = (self.home_dir, link)
+        abs_filepath = path_cache.get(key)
+        if abs_filepath is None:
+            abs_filepath = self.compute_abs_filepath(link)
+            path_cache.put(key, abs_filepath)
+        return abs_filepath
+
+    def compute_abs_filepath(self, link):
+        link = self.encode_link(link)
+
+        # 如果链接为非文件，则补上index.html
+        if link[-1] == '/':
+            link += 'index.html'
+        elif link.split('.')[-1] in DOMAIN_NAME:
+            link += '/index.html'
+
+        if ADD_HTML_SUFFIX:
+            # 如果没有文件后缀，或者非正常后缀带'%', 则补上'.html'
+            if link.split('/')[-1].find('.') < 0 or ('%' in link.split('/')[-1].split('.')[-1]):
+                link += '.html'
+
+        abs_filepath = os.path.join(self.home_dir, link[link.find('//') + 2:])
+        return abs_filepath
+
+    def find_links(self, text, pos=0, endpos=None):
+        '''
+        单次扫描文本(或其中 pos 到 endpos 的部分)，依次返回链接的起止位置、链接，以及替换时是否加引号
+        '''
+        for match in LINK_PATTERN.finditer(text, pos, len(text) if endpos is None else endpos):
+            name = match.lastgroup
+            start, end = match.span(name)
+            if name == 'attrs':
+                yield from self.find_attr_links(text, start, end)
+                continue
+            # 有引号的链接连同引号一起替换
+            if not name.endswith('uq'):
+                start, end = start - 1, end + 1
+            yield start, end, match.group(name), True
+
+    def find_attr_links(self, text, pos, endpos):
+        '''
+        依次匹配标签里的属性，返回 href、src、srcset 及 style 属性里的链接
+        '''
+        for attr in ATTR_PATTERN.finditer(text, pos, endpos):
+            name = attr.group('name').lower()
+            group = attr.lastgroup
+            # 没有值的属性
+            if group == 'name':
+                continue
+            start, end = attr.span(group)
+            if name == 'srcset':
+                # srcset 里有多个链接，只替换链接部分
+                for url in SRCSET_PATTERN.finditer(attr.group(group)):
+                    yield start + url.start(1), start + url.end(1), url.group(1), False
+            elif name == 'style':
+                yield from self.find_links(text, start, end)
+            elif name in ('href', 'src'):
+                # 有引号的链接连同引号一起替换
+                if group != 'uq':
+                    start, end = start - 1, end + 1
+                yield start, end, attr.group(group), True
+
+    def get_rel_link(self, link, current_link, curr_dir):
+        '''
+        获取链接的完整地址，及相对于当前链接文件夹的本地相对路径
+        '''
+        handled_link = self.handle_valid_link(link)
+        new_link = urljoin(current_link, handled_link)
+
+        # 如果带有#符号，将链接与#号分开，获取路径后再拼接；链接规范化后再获取路径
+        if '#' in new_link:
+            split = new_link.split('#')
+            new_link = canonicalizer.canonicalize(split[0])
+            flag = split[1]
+            new_link_path = self.get_abs_filepath(new_link)
+            new_link_path += '#{}'.format(flag)
+        else:
+            new_link = canonicalizer.canonicalize(new_link)
+            new_link_path = self.get_abs_filepath(new_link)
+
+        rel_link = os.path.relpath(new_link_path, curr_dir)
+        rel_link = rel_link.replace('\\', '/')
+
+        # 保留使用viewer.html工具打开文件
+        # if (not VIEWER_FILE_TO_LOCAL) and self.is_viewer_file_link(link):
+        #     rel_link = self.get_viewer_file_rellink(rel_link)
+        return new_link, rel_link
+
+    def replace_links(self, content, current_link):
+        '''
+        单次扫描内容，把有效链接替换为本地网站文件夹里的相对路径，一次拼接出新内容；
+        返回新内容及有效链接的完整地址
+        '''
+        curr_dir = os.path.dirname(self.get_abs_filepath(current_link))
+        # 同一文件夹下的页面，链接的完整地址相同，导航栏等重复链接可以共用缓存
+        url_parse = parse.urlsplit(current_link)
+        url_dir = parse.urlunsplit(url_parse[:2] + (url_parse.path[:url_parse.path.rfind('/') + 1], '', ''))
+        # 同一页面里重复的链接只计算一次
+        replacements = {}
+        parts = []
+        pos = 0
+        for start, end, link, quote in self.find_links(content):
+            if link not in replacements:
+                if self.is_valid_link(link):
+                    # 空链接及以'?'、'#'等开头的链接与当前页面地址有关
+                    base = current_link if link.lstrip()[:1] in ('', '?', '#', ';', '%') else url_dir
+                    key = (link, base, curr_dir)
+                    replacements[link] = rel_link_cache.get(key)
+                    if replacements[link] is None:
+                        replacements[link] = self.get_rel_link(link, current_link, curr_dir)
+                        rel_link_cache.put(key, replacements[link])
+                else:
+                    replacements[link] = None
+            if replacements[link] is None:
+                continue
+            rel_link = replacements[link][1]
+            parts.append(content[pos:start])
+            parts.append('"{}"'.format(rel_link) if quote else rel_link)
+            pos = end
+        links = set([_[0] for _ in replacements.values() if _ is not None])
+        # 没有替换的链接时返回原内容
+        if pos == 0:
+            return content, links
+        parts.append(content[pos:])
+        return ''.join(parts), links
+
+    def handle_html(self, link):
+        # 获取链接内容
+        meta = self.get_meta(link)
+        res = self.get_res(link, meta)
+        if res is None:
+            self.add_graph(link, 'failed')
+            return []
+        # 未修改则沿用上次的链接
+        if res is NOT_MODIFIED:
+            self.add_graph(link, 304, links=meta['links'])
+            return meta['links']
+        content, headers = res
+        return self.handle_content(link, content, headers, meta)
+
+    def handle_content(self, link, content, headers, meta=None):
+        '''
+        解码并处理链接内容，记录资源信息；内容哈希未变化则不重新处理，沿用上次的链接
+        '''
+        digest = hashlib.sha1(content).hexdigest()
+        charset = headers.get_content_charset() if headers is not None else None
+        if meta and meta['digest'] == digest:
+            logger.info('Unchanged\t{}'.format(link))
+            metrics.incr('unchanged')
+            links = meta['links']
+        elif self.page_pool is not None:
+            # 在子进程里解码、替换链接并保存文件
+            with metrics.timer('process'):
+                links = self.page_pool.process(link, content, charset)
+        else:
+            with metrics.timer('decode'):
+                text, encoding = self.decode_res(link, content, charset)
+            links = self.handle_text(link, text, encoding, content, headers) if text is not None else None
+        self.add_graph(link, 200, headers, len(content), links or [])
+        # 解码失败
+        if links is None:
+            return []
+        self.save_meta(link, headers, digest, links)
+        return links
+
+    def handle_text(self, link, text, encoding, content=None, headers=None):
+        '''
+        提取、替换文本中的链接并按页面的编码保存文件，返回新链接；
+        没有链接需要替换且有原始内容 content 时，直接保存原始内容，不重新编码
+        '''
+        # 提取有效的链接，并替换 text 内容里的链接为本地网站文件夹里的相对路径
+        with metrics.timer('rewrite'):
+            new_text, links = self.replace_links(text, link)
+        if new_text is text and content is not None:
+            new_text = content
+        # 保存 text 文件
+        with metrics.timer('write'):
+            self.save_link_file(link, new_text, encoding, headers)
+
+        # 返回有效的链接供放入爬虫队列
+        return links
+
+    def get_viewer_file_link(self, link):
+        '''
+        如果是viewer链接，获取指定的文件路径
+        '''
+        link = parse.unquote(link)
+        if 'viewer.html?file=' in link:
+            link = link.split('viewer.html?file=')[-1]
+        return link
+
+    def is_viewer_file_link(self, link):
+        return 'viewer.html' in link
+
+    def get_viewer_file_rellink(self, link):
+        '''
+        获取viewer file的路径名
+        '''
+        ulink = parse.unquote(link)
+        if 'viewer.html?file=' in ulink:
+            # 相对与viewer的路径
+            link = ulink.split('viewer.html?file=')[0] + 'viewer.html?file=..' + ulink.split('viewer.html?file=')[1]
+        link = 'web/viewer.html?file={}'.format(link)
+        return link
+
+    def is_pdf_valid(self, path, link=None):
+        '''
+        快速检查本地PDF文件，文件大小及修改时间与校验记录一致时沿用记录的结果，
+        否则只检查文件头及结尾并记录；完整解析由 PdfVerifier 在后台进程池里进行
+        '''
+        stat = os.stat(path)
+        check = self.state.get_check(path) if self.state is not None else None
+        if check is not None and check[:2] == (stat.st_size, stat.st_mtime_ns):
+            return check[2] != 'bad'
+        state = is_pdf_intact(path, stat.st_size)
+        metrics.incr('pdf_checks')
+        if not state:
+            logger.warning('[invalid pdf]\t{}'.format(path))
+        if self.state is not None:
+            self.state.set_check(path, link, stat.st_size, stat.st_mtime_ns, 'ok' if state else 'bad')
+        return state
+
+    def rewrite_playlist(self, link, text, depth=0):
+        '''
+        把 HLS 播放列表里的链接替换为本地相对路径，返回新内容、子播放列表及分片的完整地址；
+        嵌套超过 HLS_MAX_DEPTH 层的子播放列表不下载，保留完整地址
+        '''
+        curr_dir = os.path.dirname(self.get_abs_filepath(link))
+        playlists, segments = OrderedDict(), OrderedDict()
+        parts = []
+        pos = 0
+        for start, end, uri, is_playlist in find_playlist_uris(text):
+            new_link = canonicalizer.canonicalize(urljoin(link, uri))
+            if is_playlist and depth >= HLS_MAX_DEPTH:
+                logger.warning('playlist too deep, kept as url\t{}'.format(new_link))
+                parts += [text[pos:start], urljoin(link, uri)]
+                pos = end
+                continue
+            (playlists if is_playlist else segments)[new_link] = True
+            rel_link = os.path.relpath(self.get_abs_filepath(new_link), curr_dir).replace('\\', '/')
+            parts += [text[pos:start], rel_link]
+            pos = end
+        parts.append(text[pos:])
+        return ''.join(parts), list(playlists), list(segments)
+
+    def handle_playlist(self, link, depth=0):
+        '''
+        处理 HLS 播放列表：分片在共用的线程池里并发下载，已下载的跳过、未完成的续传，失败的分片记入失败链接稍后重试；
+        子播放列表(主播放列表里的各码率、音轨)递归处理，最后把链接替换为本地相对路径保存播放列表。
+        增量更新时发送条件请求，播放列表未修改或内容未变化则不再检查分片，只递归检查子播放列表
+        '''
+        meta = self.get_meta(link)
+        res = self.get_res(link, meta)
+        if res is None:
+            self.add_graph(link, 'failed')
+            return []
+        if res is NOT_MODIFIED:
+            self.add_graph(link, 304, links=meta['links'])
+            [self.handle_playlist(playlist, depth + 1) for playlist in meta['links'] if is_playlist_link(playlist)]
+            return []
+        content, headers = res
+        digest = hashlib.sha1(content).hexdigest()
+        if meta and meta['digest'] == digest:
+            logger.info('Unchanged\t{}'.format(link))
+            metrics.incr('unchanged')
+            self.save_meta(link, headers, digest, meta['links'])
+            self.add_graph(link, 200, headers, len(content), meta['links'])
+            [self.handle_playlist(playlist, depth + 1) for playlist in meta['links'] if is_playlist_link(playlist)]
+            return []
+        text, encoding = self.decode_res(link, content, headers.get_content_charset())
+        if text is None:
+            return []
+        new_text, playlists, segments = self.rewrite_playlist(link, text, depth)
+        logger.info('playlist\t{}: {} playlists, {} segments'.format(link, len(playlists), len(segments)))
+        metrics.incr('hls_segments', len(segments))
+        if self.hls_pool is not None:
+            list(self.hls_pool.map(lambda segment: self.download(segment, 'media'), segments))
+        else:
+            [self.download(segment, 'media') for segment in segments]
+        for playlist in playlists:
+            self.handle_playlist(playlist, depth + 1)
+        self.save_link_file(link, new_text, encoding, headers)
+        self.save_meta(link, headers, digest, playlists + segments)
+        self.add_graph(link, 200, headers, len(content), playlists + segments)
+        return []
+
+    def get_saved_size(self, file_path, link):
+        '''
+        已保存的下载文件的大小，未保存或PDF文件无效时返回 None
+        '''
+        if self.archive is not None:
+            return self.archive.get_size(file_path) if self.archive.has(file_path) else None
+        # 判断PDF文件是否有效
+        if os.path.exists(file_path) and (not file_path.endswith('.pdf') or self.is_pdf_valid(file_path, link)):
+            return os.path.getsize(file_path)
+        return None
+
+    def open_part(self, link):
+        '''
+        返回下载的本地路径及临时文件，归档时不创建网站目录
+        '''
+        if self.archive is not None:
+            file_path = self.get_abs_filepath(link)
+            return file_path, PartFile(file_path, self.archive.get_part_path(file_path))
+        file_path = self.make_filepath(link)
+        return file_path, PartFile(file_path)
+
+    def commit_part(self, link, part):
+        '''
+        保存下载完成的临时文件，返回内容哈希
+        '''
+        if self.archive is not None:
+            return self.archive.put_part(link, part)
+        digest = part.commit(link, self.blob_store)
+        if part.file_path.endswith('.pdf'):
+            self.is_pdf_valid(part.file_path, link)
+        return digest
+
+    def probe(self, link):
+        '''
+        用 HEAD 请求探测链接类型，返回链接所属通道；失败则按页面处理
+        '''
+        try:
+            with scheduler.request(link), metrics.inflight(link), metrics.timer('fetch'):
+                res = opener.open(Request(link, method='HEAD'))
+                res.read()
+            scheduler.record(link)
+            metrics.incr('requests')
+            metrics.incr('probes')
+        except Exception as e:
+            scheduler.record(link, e)
+            logger.warning('[{}]\t probe {}'.format(repr(e), link))
+            return 'page'
+        return response_lane(res.headers)
+
+    def download(self, link, lane=None):
+        '''
+        直接下载链接文件，大文件通道的链接用较长的超时时间
+        '''
+        lane = lane or link_lane(link)
+        socket.setdefaulttimeout(SOCKET_DEFAULT_TIMEOUT)
+        if lane == 'media':
+            socket.setdefaulttimeout(SOCKET_DOWNLOAD_TIMEOUT)
+        meta = self.get_meta(link)
+        headers = self.make_conditional_headers(meta)
+        num_tries = 0
+        # 多次尝试下载，失败后按退避时间等待
+        while True:
+            try:
+                file_path, part = self.open_part(link)
+
+                # 如果文件存在则不重新下载，增量更新时发送条件请求
+                size = None if self.update else self.get_saved_size(file_path, link)
+                if size is not None:
+                    logger.info('exists \t{0}'.format(link))
+                    self.add_graph(link, 'exists', size=size)
+                    return
+                # 先写入临时文件，已有部分内容则续传
+                with scheduler.request(link, lane), metrics.inflight(link), metrics.timer('download'):
+                    res = opener.open(Request(link, headers=dict(headers, **part.range_headers())))
+                    try:
+                        shutil.copyfileobj(res, part.open(res.status, res.headers), DOWNLOAD_CHUNK_SIZE)
+                    finally:
+                        part.close()
+                scheduler.record(link)
+                metrics.incr('requests')
+                metrics.incr('bytes', part.size - part.offset)
+                self.save_meta(link, res.headers, self.commit_part(link, part))
+                self.add_graph(link, res.status, res.headers, part.size)
+                break
+            except Exception as e:
+                if isinstance(e, HTTPError) and e.code == 304:
+                    scheduler.record(link)
+                    metrics.incr('requests')
+                    metrics.incr('not_modified')
+                    logger.info('Not modified\t{}'.format(link))
+                    self.add_graph(link, 304)
+                    return
+                if isinstance(e, HTTPError) and e.code == 416:
+                    part.discard()
+                num_tries += 1
+                logger.warning('[{}]\t {} retry{}'.format(repr(e), link, num_tries))
+                if not self.wait_retry(link, num_tries, e):
+                    logger.error('[failed download]\t{0}'.format(link))
+                    self.error_links.add(link)
+                    self.add_graph(link, 'failed')
+                    return
+        logger.info('Downloaded\t{0}'.format(link))
+
+    def handle(self, link):
+        logger.info("{}, handle: {}".format(threading.current_thread().name, link))
+        links = []
+        # 记录耗时及线程CPU时间，区分网络等待与页面处理
+        start, cpu = time.perf_counter(), time.thread_time()
+
+        try:
+            # 后缀未知的链接先探测类型，不是页面则移到对应通道
+            if self.queue.needs_probe(link):
+                lane = self.probe(link)
+                if lane != 'page':
+                    self.queue.defer(link, lane)
+                    return DEFERRED
+            # 按链接所在通道处理
+            lane = self.queue.get_lane(link)
+            if is_playlist_link(link):
+                links = self.handle_playlist(link)
+            elif lane == 'page':
+                links = self.handle_html(link)
+            else:
+                self.download(link, lane)
+        finally:
+            metrics.handled(threading.current_thread().name, time.perf_counter() - start, time.thread_time() - cpu)
+        return links
+
+    def run(self):
+        logger.info('{} start.'.format(threading.current_thread().name))
+        self.running = True
+        while self.running:
+            # 从管理器queue获取link，全部链接完成则退出
+            link = self.queue.get()
+            if link is None:
+                break
+            logger.info('{} - queue size: {}'.format(threading.current_thread().name, self.queue.qsize()))
+            self.process(link)
+        logger.info('{} end.'.format(threading.current_thread().name))
+
+    def process(self, link):
+        '''
+        处理从链接队列取出的链接，新链接直接放入队列，完成后通知队列
+        '''
+        failed = True
+        links = []
+        try:
+            links = self.handle(link)
+            if links is DEFERRED:
+                return
+            for new_link in links:
+                self.queue.put(new_link)
+            failed = link in self.error_links
+        except Exception:
+            logger.error('{}, {}'.format(link, traceback.format_exc()))
+        finally:
+            # 移到其他通道的链接稍后再处理
+            if links is not DEFERRED:
+                self.queue.task_done(link, failed, not self.is_write_pending(link) or failed)
+
+    def close(self):
+        '''
+        提供管理器退出爬虫线程
+        '''
+        self.running = False
+
+    def get_error_links(self):
+        '''
+        提供主线程爬虫管理器再次放入爬虫链接队列
+        '''
+        export_links = self.error_links.copy()
+        self.error_links.clear()
+        return export_links
+
+
+# 页面处理子进程里按网站缓存的 spider
+process_spiders = {}
+
+
+def process_page(home_dir, netloc, update, link, content, charset=None):
+    '''
+    在页面处理子进程里解码页面、替换链接并保存文件，返回新链接，解码失败返回 None；
+    charset 为响应头声明的编码
+    '''
+    key = (home_dir, netloc, update)
+    if key not in process_spiders:
+        process_spiders[key] = Spider(None, home_dir, netloc, None, update)
+    spider = process_spiders[key]
+    text, encoding = spider.decode_res(link, content, charset)
+    if text is None:
+        return None
+    return spider.handle_text(link, text, encoding, content)
+
+
+class PagePool(object):
+    '''
+    页面处理进程池，页面的解码、链接提取及替换在多个子进程里进行，新链接返回给爬虫放入链接队列；
+    抓取仍由爬虫线程或异步引擎并发进行。worker 可替换为其他同参数的页面处理函数。
+
+    参数：
+        processes:  int,        子进程数；
+        home_dir:   str,        网站保存的文件home路径；
+        netloc:     str,        网站点；
+        update:     bool,       增量更新，内容变化则覆盖文件；
+        worker:     function,   子进程里的页面处理函数，默认 process_page；
+        executor:   ProcessPoolExecutor,    多个网站共用的进程池，为空则新建。
+
+    例子：
+        pool = PagePool(16, home_dir, netloc)
+        links = pool.process(link, content)
+        pool.close()
+    '''
+
+    def __init__(self, processes, home_dir, netloc, update=False, worker=process_page, executor=None):
+        self.home_dir = home_dir
+        self.netloc = netloc
+        self.update = update
+        self.worker = worker
+        self.executor = executor
+        if executor is None:
+            self.executor = ProcessPoolExecutor(processes)
+            # 在爬虫线程启动前创建子进程
+            self.executor.submit(int).result()
+
+    def submit(self, link, content, charset=None):
+        return self.executor.submit(self.worker, self.home_dir, self.netloc, self.update, link, content, charset)
+
+    def process(self, link, content, charset=None):
+        return self.submit(link, content, charset).result()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def is_pdf_intact(path, size):
+    '''
+    只读取文件头尾，检查'%PDF'文件头及'%%EOF'结尾
+    '''
+    if size < len(b'%PDF') + len(b'%%EOF'):
+        return False
+    with open(path, 'rb') as fp:
+        head = fp.read(1024)
+        fp.seek(max(0, size - 1024))
+        tail = fp.read()
+    return b'%PDF' in head and b'%%EOF' in tail
+
+
+def check_pdf(path):
+    '''
+    用 PyPDF2 完整解析PDF文件，至少有一页为有效
+    '''
+    state = True
+    try:
+        reader = PdfFileReader(path)
+        if reader.getNumPages() < 1:
+            state = False
+    except Exception:
+        state = False
+        logger.warning('{}, {}'.format(path, traceback.format_exc()))
+    return state
+
+
+class PdfVerifier(object):
+    '''
+    后台PDF深度校验，在进程池里完整解析只经过快速检查的PDF文件，不占用爬虫线程；
+    解析失败的文件删除后返回其链接，供重新下载。
+
+    参数：
+        state:      CrawlState, 爬取状态，记录PDF文件的校验结果；
+        processes:  int,        子进程数。
+
+    例子：
+        verifier = PdfVerifier(state, 4)
+        verifier.submit()  # 在后台校验已有的PDF文件
+        bad_links = verifier.collect()
+        verifier.close()
+    '''
+
+    def __init__(self, state, processes):
+        self.state = state
+        self.executor = ProcessPoolExecutor(processes)
+        self.futures = {}
+
+    def submit(self):
+        '''
+        提交尚未深度校验的PDF文件，已提交的不重复提交
+        '''
+        for path, link in self.state.checks('ok'):
+            if path in self.futures or not os.path.exists(path):
+                continue
+            stat = os.stat(path)
+            self.futures[path] = (link, stat, self.executor.submit(check_pdf, path))
+
+    def collect(self):
+        '''
+        提交本次新下载的PDF文件，等待全部校验完成，返回损坏文件的链接
+        '''
+        self.submit()
+        bad_links = set()
+        for path, (link, stat, future) in self.futures.items():
+            if future.result():
+                self.state.set_check(path, link, stat.st_size, stat.st_mtime_ns, 'verified')
+                continue
+            logger.warning('[invalid pdf]\t{}'.format(path))
+            metrics.incr('pdf_bad')
+            self.state.set_check(path, link, stat.st_size, stat.st_mtime_ns, 'bad')
+            if os.path.exists(path):
+                os.remove(path)
+            if link:
+                bad_links.add(link)
+        logger.info('pdf verified: {}, bad: {}'.format(len(self.futures), len(bad_links)))
+        self.futures = {}
+        return bad_links
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class Manager(object):
+    '''
+    爬虫主管理器，开启爬虫线程，提供去重的链接队列于爬虫线程获取及放入新链接，等待全部链接完成。
+
+    参数：
+        url:    str,    网站地址，格式如为'http://www.xxx.com'；
+        resume: bool,   是否从上次中断的爬取状态继续；
+        update: bool,   增量更新，用条件请求跳过未修改的链接；
+        processes:  int,    页面处理子进程数，为0则在爬虫线程里处理页面；
+        dedup:  bool,   下载文件按内容去重存储，相同内容只保存一份并硬链接到各个路径；
+        verify_pdf: int,    PDF深度校验子进程数，为0则只做快速检查；
+        bloom:  int,    大于0时用按此链接数分配的布隆过滤器记录已发现的链接，否则用64位指纹集合；
+        graph:  str,    链接图导出的 JSON lines 文件路径，为空则不导出；
+        robots: bool,   遵守 robots.txt 的禁止规则及 Crawl-delay；
+        seed_sitemaps:  bool,   爬虫开始前从 robots.txt 列出的 sitemap(没有则为'/sitemap.xml')放入全部链接；
+        head_probe: bool,   后缀未知的链接先用 HEAD 请求按 Content-Type、Content-Length 分到页面、小文件或大文件通道；
+        writers:    int,    页面文件写入线程数，为0则在爬虫里直接写入；
+        fsync:      bool,   写入线程重命名前把文件同步到磁盘；
+        archive:    str,    归档格式'warc'、'tar' 或 'zip'，页面及下载文件追加到滚动的归档文件，为空则保存为单独的文件；
+        archive_size:   int,    归档文件超过此字节数后换新文件；
+        hls_workers:    int,    所有 HLS 播放列表共用的分片并发下载数。
+
+    例子：
+        url = 'http://www.daorenjia.com'
+        m = Manager(url)
+        m.start()
+
+    '''
+
+    def __init__(self, url, resume=False, update=False, processes=0, dedup=False, verify_pdf=0, bloom=0,
+                 graph=None, robots=False, seed_sitemaps=False, head_probe=False, writers=0, fsync=False,
+                 archive=None, archive_size=ARCHIVE_MAX_SIZE, hls_workers=HLS_WORKERS):
+        self.url = canonicalizer.canonicalize(url.replace('\\', '/'))
+        self.resume = resume
+        self.update = update
+        self.processes = processes
+        self.dedup = dedup
+        self.verify_pdf = verify_pdf
+        self.bloom = bloom
+        self.graph_path = graph
+        self.graph = None
+        self.obey_robots = robots
+        self.seed_sitemaps = seed_sitemaps
+        self.writers = writers
+        self.fsync = fsync
+        self.writer = None
+        self.archive_kind = archive
+        self.archive_size = archive_size
+        self.archive = None
+        self.hls_workers = hls_workers
+        self.hls_pool = None
+        self.robots_file = None
+        self.robots = None
+        self.page_pool = None
+        self.blob_store = None
+        self.pdf_verifier = None
+        self.state = None
+        self.frontier = Frontier(self.handle_link, self.is_valid_link, head_probe=head_probe)
+        self.spiders = []
+        metrics.gauge('queue_depth', self.frontier.qsize)
+        metrics.gauge('unfinished', lambda: self.frontier.unfinished)
+
+    def is_valid_link(self, link):
+        '''
+        判断是否url下的链接，链接已规范化
+        '''
+        # if link.find('http') >= 0:
+        #     netloc = urlparse(link).netloc
+        #     if netloc:
+        #         if netloc.find(':{}'.format(PORT)) > 0:
+        #             netloc = netloc.replace(':{}'.format(PORT), '')
+        #         # return netloc[netloc.find('.') + 1:] == self.netloc[self.netloc.find('.') + 1:]
+        #         return netloc == self.netloc
+        if not link.startswith(self.url):
+            return False
+        # 遵守 robots.txt 的禁止规则
+        return self.robots is None or self.robots.can_fetch(USER_AGENT, link)
+
+    def handle_link(self, link):
         '''
-        处理链接，去掉#号的链接
+        处理链接，去掉#号的链接，并规范化用于去重
         '''
         sharp_index = link.find('#')
         if sharp_index > 0:
             logger.info("-{}".format(link))
             link = link[0:sharp_index]
-        return link
+        return canonicalizer.canonicalize(link)
 
-    def start(self):
+    def make_home_dir(self):
+        '''
+        创建网站保存的home目录，返回home目录及网站点
+        '''
         url_parse = urlparse(self.url)
         home_dir = "{}-site/".format(url_parse.netloc)
         netloc = url_parse.netloc
@@ -495,85 +3022,1142 @@ class Manager(object):
         # 创建home目录文件夹
         if not os.path.exists(home_dir):
             os.makedirs(home_dir)
+        return home_dir, netloc
 
-        logger.info("start...")
-        # 新建且启动多个爬虫线程
-        logger.info("Thread number: {}".format(THREAD_NUM))
-        [self.spiders.append(Spider(self.queue, home_dir, netloc)) for i in range(THREAD_NUM)]
+    def seed_frontier(self, home_dir):
+        '''
+        打开爬取状态，续爬时从中恢复链接队列，否则清空状态并放入网址
+        '''
+        self.state = CrawlState('{}.db'.format(home_dir.rstrip('/')))
+        self.frontier.state = self.state
+        if self.bloom > 0:
+            # 布隆过滤器判断已存在时到爬取状态里确认
+            self.frontier.seen = BloomSeen(self.state, self.bloom)
+        if self.resume:
+            num = self.frontier.load_state()
+            logger.info('resume: {} links, {} to crawl.'.format(len(self.frontier.seen), num))
+            if len(self.frontier.seen):
+                return
+        else:
+            self.state.clear()
+        self.frontier.put(self.url)
+        # 从 sitemap 放入链接，爬虫开始时就有足够的链接
+        if self.seed_sitemaps:
+            self.seed_from_sitemaps(self.robots_file)
+
+    def load_robots(self):
+        '''
+        获取并解析 robots.txt；与 RobotFileParser.read 相同，401/403 视为全部禁止，其他错误视为全部允许
+        '''
+        robots = RobotFileParser(urljoin(self.url, '/robots.txt'))
+        try:
+            # 关闭响应，连接放回连接池；错误响应同样关闭
+            with opener.open(Request(robots.url), timeout=SOCKET_DEFAULT_TIMEOUT) as res:
+                robots.parse(res.read().decode('utf-8', 'replace').splitlines())
+        except HTTPError as e:
+            e.close()
+            if e.code in (401, 403):
+                logger.warning('[robots.txt {}] all links disallowed'.format(e.code))
+                robots.disallow_all = True
+            else:
+                robots.allow_all = True
+        except Exception as e:
+            logger.warning('[{}]\t{}'.format(repr(e), robots.url))
+            robots.allow_all = True
+        return robots
+
+    def seed_from_sitemaps(self, robots):
+        '''
+        流式解析 sitemap 及 sitemap 索引，把其中的链接放入队列，返回放入的链接数
+        '''
+        sitemaps = robots.site_maps() if robots else None
+        # robots.txt 里的 sitemap 可能是相对地址，按 robots.txt 的地址补全
+        sitemaps = deque([urljoin(robots.url, sitemap) for sitemap in sitemaps] if sitemaps
+                         else [urljoin(self.url, '/sitemap.xml')])
+        fetched = set()
+        num = 0
+        while sitemaps and len(fetched) < SITEMAP_MAX_FILES:
+            sitemap = sitemaps.popleft()
+            if sitemap in fetched:
+                continue
+            fetched.add(sitemap)
+            try:
+                # 解析完或出错时关闭响应，未读完的连接不再复用
+                with opener.open(Request(sitemap), timeout=SOCKET_DEFAULT_TIMEOUT) as res:
+                    for is_index, link in parse_sitemap(res):
+                        if is_index:
+                            sitemaps.append(link)
+                        elif self.frontier.put(link):
+                            num += 1
+            except (OSError, ParseError, EOFError, HTTPError, ValueError) as e:
+                if isinstance(e, HTTPError):
+                    e.close()
+                logger.warning('[{}]\t{}'.format(repr(e), sitemap))
+        logger.info('sitemap seed: {} links from {} sitemaps'.format(num, len(fetched)))
+        return num
+
+    def setup_robots(self):
+        '''
+        爬虫开始前获取 robots.txt，遵守时设置禁止规则及 Crawl-delay(未设定 --rate 时)
+        '''
+        if not (self.obey_robots or self.seed_sitemaps):
+            return
+        self.robots_file = self.load_robots()
+        if self.obey_robots:
+            self.robots = self.robots_file
+            delay = self.robots.crawl_delay(USER_AGENT)
+            if delay and not scheduler.rate:
+                # 只限制本网站的 host，批量爬取时不影响其他网站
+                scheduler.set_rate(self.url, 1 / float(delay))
+                logger.info('robots.txt crawl delay: {}s'.format(delay))
+
+    def start_page_pool(self, home_dir, netloc):
+        # 子进程不能写入本进程的归档文件
+        if self.processes > 0 and self.archive_kind:
+            logger.warning('page processes are not used with --archive, pages are handled in the crawler')
+        elif self.processes > 0:
+            logger.info("Page process number: {}".format(self.processes))
+            self.page_pool = PagePool(self.processes, home_dir, netloc, self.update)
+
+    def start_writer(self):
+        if self.writers > 0:
+            logger.info("Writer thread number: {}".format(self.writers))
+            self.writer = FileWriter(self.writers, WRITER_QUEUE_SIZE, self.fsync)
+
+    def start_hls_pool(self):
+        # 所有爬虫线程共用的分片下载线程池，用到时才创建线程
+        if self.hls_workers > 0:
+            self.hls_pool = ThreadPoolExecutor(self.hls_workers, thread_name_prefix='hls')
+
+    def open_archive(self, home_dir):
+        '''
+        归档时在网站home目录旁边打开归档存储
+        '''
+        if self.archive_kind:
+            self.archive = ArchiveStore('{}-archive'.format(home_dir.rstrip('/')), self.archive_kind,
+                                        self.archive_size)
+
+    def open_blob_store(self, home_dir):
+        '''
+        按内容去重时，在网站home目录旁边打开内容寻址存储；归档时不使用
+        '''
+        if self.dedup and not self.archive_kind:
+            self.blob_store = BlobStore('{}-blobs'.format(home_dir.rstrip('/')))
+
+    def start_pdf_verifier(self):
+        '''
+        在后台进程池里深度校验上次已下载的PDF文件，需在打开爬取状态之后调用
+        '''
+        if self.verify_pdf > 0:
+            logger.info("PDF verify process number: {}".format(self.verify_pdf))
+            self.pdf_verifier = PdfVerifier(self.state, self.verify_pdf)
+            self.pdf_verifier.submit()
+
+    def open_link_graph(self):
+        '''
+        打开链接图导出文件，续爬时追加
+        '''
+        if self.graph_path:
+            self.graph = LinkGraph(self.graph_path, append=self.resume)
+
+    def verify_pdfs(self):
+        '''
+        等待PDF深度校验完成，返回需要重新下载的链接
+        '''
+        if self.pdf_verifier is None:
+            return set()
+        return self.pdf_verifier.collect()
+
+    def finish(self):
+        self.close()
+        logger.info('path cache: {}, rel link cache: {}'.format(path_cache.stats(), rel_link_cache.stats()))
+        logger.info('metrics: {}'.format(metrics.summary()))
+
+        # 响铃提醒下载完成
+        for i in range(6 if BELL else 0):
+            print('\a')
+            time.sleep(0.5)
+
+        logger.info("finish.")
+
+    def close(self):
+        '''
+        关闭爬取状态、进程池、存储等
+        '''
+        # 等待页面文件全部写入
+        if self.writer is not None:
+            self.writer.close()
+        if self.hls_pool is not None:
+            self.hls_pool.shutdown()
+        if self.pdf_verifier is not None:
+            self.pdf_verifier.close()
+        self.state.close()
+        if self.page_pool is not None:
+            self.page_pool.close()
+        if self.blob_store is not None:
+            self.blob_store.close()
+        if self.archive is not None:
+            self.archive.close()
+        if self.graph is not None:
+            self.graph.close()
+
+    def start_spiders(self, num, home_dir, netloc):
+        self.frontier.set_workers(num)
+        self.spiders = [
+            Spider(self.frontier, home_dir, netloc, self.state, self.update, self.page_pool, self.blob_store,
+                   self.graph, self.writer, self.archive, self.hls_pool)
+            for i in range(num)
+        ]
         [spider.start() for spider in self.spiders]
 
+    def join_spiders(self):
+        '''
+        链接全部完成后爬虫线程自行退出，等待其结束
+        '''
+        [spider.join() for spider in self.spiders]
+
+    def get_error_links(self):
+        # 等待写入线程写完，写入失败的页面也作为失败链接
+        if self.writer is not None:
+            self.writer.flush()
+        error_links = set()
+        for spider in self.spiders:
+            error_links |= spider.get_error_links()
+        return error_links
+
+    def start(self):
+        home_dir, netloc = self.make_home_dir()
+
+        logger.info("start...")
+        self.start_page_pool(home_dir, netloc)
+        self.start_writer()
+        self.start_hls_pool()
+        self.open_archive(home_dir)
+        self.open_blob_store(home_dir)
+        self.open_link_graph()
         # 将网址放入队列
-        self.links.add(self.url)
-        self.queue.put(self.url)
+        self.setup_robots()
+        self.seed_frontier(home_dir)
+        self.start_pdf_verifier()
+
+        # 新建且启动多个爬虫线程，等待全部链接完成
+        logger.info("Thread number: {}".format(THREAD_NUM))
+        self.start_spiders(THREAD_NUM, home_dir, netloc)
+        self.frontier.join()
+        self.join_spiders()
+
+        # 从子线程获取失败链接，及深度校验失败的PDF文件
+        error_links = self.get_error_links() | self.verify_pdfs()
+        logger.info('error links: {}, len={}'.format(error_links, len(error_links)))
+
+        ''' 将失败的链接重新加入队列，仅一次 '''
+        if len(error_links):
+            # 若有失败连接，则重新放入队列，且保留少量线程
+            logger.info("Thread reduce to {}, and try error link again.".format(TRY_ERROR_LINK_THREAD_NUM))
+            self.frontier.retry(error_links)
+            self.start_spiders(TRY_ERROR_LINK_THREAD_NUM, home_dir, netloc)
+            self.frontier.join()
+            self.join_spiders()
+            error_links = self.get_error_links()
+            logger.info('error links: {}, len={}'.format(error_links, len(error_links)))
+
+        self.finish()
+
+
+class CookieResponse(object):
+    '''
+    供 CookieJar 从异步响应头中提取 cookie
+    '''
+
+    def __init__(self, headers):
+        self.headers = headers
+
+    def info(self):
+        return self.headers
 
-        retry_error_link = True  # 用于判断是否将异常链接重新放入工作队列
+
+class AsyncFetcher(object):
+    '''
+    异步 HTTP/1.1 客户端，按 host 复用 keep-alive 连接并限制每个 host 的并发数，与 opener 共用 cookie；
+    大文件通道的请求最多占用每个 host 并发数的 HOST_MEDIA_RATIO。超时只计算取得并发数之后的连接及读写时间。
+
+    参数：
+        host_concurrency:   int,    每个host的并发请求数；
+        pool_size:          int,    每个host保持的空闲连接数。
+
+    例子：
+        fetcher = AsyncFetcher()
+        status, headers, content = await fetcher.fetch('http://www.daorenjia.com/', timeout=60)
+        await fetcher.close()
+    '''
+
+    def __init__(self, host_concurrency=ASYNC_HOST_CONCURRENCY, pool_size=POOL_SIZE):
+        self.host_concurrency = host_concurrency
+        self.pool_size = pool_size
+        self.semaphores = {}
+        self.media_semaphores = {}
+        self.idle_conns = {}
+        self.ssl_context = ssl._create_unverified_context()
+
+    def get_semaphore(self, netloc):
+        if netloc not in self.semaphores:
+            self.semaphores[netloc] = asyncio.Semaphore(self.host_concurrency)
+        return self.semaphores[netloc]
+
+    def get_media_semaphore(self, netloc):
+        if netloc not in self.media_semaphores:
+            self.media_semaphores[netloc] = asyncio.Semaphore(max(1, int(self.host_concurrency * HOST_MEDIA_RATIO)))
+        return self.media_semaphores[netloc]
+
+    async def fetch(self, link, open_fp=None, headers=None, method='GET', timeout=None, lane=None):
+        '''
+        获取链接，跟随重定向，返回状态码、响应头及内容；
+        open_fp 不为空时，200、206 响应以状态码及响应头调用 open_fp 获取文件，将内容分块写入，不返回内容；
+        method 为 'HEAD' 时只返回响应头；timeout 为每次请求的连接及读写超时，不包括等待 host 并发数及预约时间；
+        lane 为 'media' 时先占用 host 的大文件并发数
+        '''
+        for i in range(MAX_REDIRECTS + 1):
+            netloc = urlparse(link).netloc
+            media = self.get_media_semaphore(netloc) if lane == 'media' else contextlib.nullcontext()
+            async with media, self.get_semaphore(netloc):
+                # 等待到 host 调度预约的请求时间
+                wait = scheduler.reserve(link)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                with metrics.inflight(link), metrics.timer('download' if open_fp else 'fetch'):
+                    status, res_headers, content = await asyncio.wait_for(
+                        self.request(link, open_fp, headers, method), timeout
+                    )
+            if status in (301, 302, 303, 307, 308) and res_headers.get('Location'):
+                link = urljoin(link, res_headers.get('Location'))
+                continue
+            if status >= 400:
+                raise HTTPError(link, status, client.responses.get(status, ''), res_headers, None)
+            return status, res_headers, content
+        raise HTTPError(link, status, 'too many redirects', res_headers, None)
+
+    async def request(self, link, open_fp=None, headers=None, method='GET'):
+        url_parse = urlparse(link)
+        port = url_parse.port or (443 if url_parse.scheme == 'https' else 80)
+        key = (url_parse.scheme, url_parse.hostname, port)
+        target = url_parse.path or '/'
+        if url_parse.query:
+            target += '?' + url_parse.query
+        # 链接里的中文等字符需编码后才能发送
+        target = parse.quote(target, safe=''.join(map(chr, range(33, 127))))
+
+        req = Request(link, headers=headers or {})
+        cookie.add_cookie_header(req)
+        lines = [
+            '{} {} HTTP/1.1'.format(method, target),
+            'Host: {}'.format(url_parse.netloc),
+            'User-Agent: {}'.format(USER_AGENT),
+            'Accept-Encoding: identity',
+            'Connection: keep-alive',
+        ]
+        lines += ['{}: {}'.format(k, v) for k, v in req.header_items()]
+        data = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        # 复用的空闲连接可能已被服务器关闭，此时换新连接重试一次
         while True:
-            # 遍历爬虫列表，获取结果，将新的link放入队列
-            for spider in self.spiders:
-                new_links = spider.get_links()
-                for link in new_links:
-                    link = self.handle_link(link)
-                    if self.is_valid_link(link) and (link not in self.links):
-                        self.links.add(link)
-                        self.queue.put(link)
-            # 判断是否工作结束
-            # 如果队列为空，且爬虫线程都没有在工作，则结束
-            if self.queue.empty():
-                state = [spider.is_working() for spider in self.spiders]
-                if True in state:
-                    logger.info('queue is empty, but {} spider working.'.format(state.count(True)))
-                    logger.info('{}'.format(state))
-                    time.sleep(SPIDER_GET_LINK_TIMEOUT)
-                else:
-                    logger.info('queue is empty, and no spider working.')
-
-                    # 从子线程获取失败链接
-                    error_links = set()
-                    for spider in self.spiders:
-                        error_links |= spider.get_error_links()
-                    logger.info('error links: {}, len={}'.format(error_links, len(error_links)))
-
-                    ''' 将失败的链接重新加入队列，仅一次 '''
-                    if retry_error_link and len(error_links):
-                        # 若有失败连接，则重新放入队列，且保留少量线程
-                        logger.info("Thread reduce to {}, and try error link again.".format(TRY_ERROR_LINK_THREAD_NUM))
-                        for spider in self.spiders[TRY_ERROR_LINK_THREAD_NUM:]:
-                            spider.running = False  # 退出线程
-                        time.sleep(SPIDER_GET_LINK_TIMEOUT)
-                        self.spiders = self.spiders[:TRY_ERROR_LINK_THREAD_NUM]
-                        [self.queue.put(link, True) for link in error_links]
-
-                        retry_error_link = False
-
-                        time.sleep(0.1)
-                        logger.info('continue.')
-                        continue
-                    logger.info('break.')
+            reader, writer, reused = await self.get_conn(key)
+            try:
+                writer.write(data)
+                await writer.drain()
+                status_line = await reader.readline()
+                if not status_line:
+                    raise ConnectionResetError('connection closed by server')
+                break
+            except (ConnectionError, OSError):
+                writer.close()
+                if not reused:
+                    raise
+        try:
+            status = int(status_line.split()[1])
+            header_lines = []
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                header_lines.append(line)
+            headers = client.parse_headers(io.BytesIO(b''.join(header_lines) + b'\r\n'))
+            cookie.extract_cookies(CookieResponse(headers), req)
+
+            # 非200、206响应不写入文件
+            fp = None
+            if open_fp is not None and status in (200, 206):
+                fp = open_fp(status, headers)
+            sink = fp if fp is not None else io.BytesIO()
+            # HEAD 请求及 204、304 响应没有内容
+            keep_alive = method == 'HEAD' or status in (204, 304) or await self.read_body(reader, headers, sink)
+        except BaseException:
+            writer.close()
+            raise
+        conns = self.idle_conns.setdefault(key, [])
+        if keep_alive and headers.get('Connection', '').lower() != 'close' and len(conns) < self.pool_size:
+            conns.append((reader, writer))
+        else:
+            writer.close()
+        content = sink.getvalue() if sink is not fp else None
+        return status, headers, content
+
+    async def get_conn(self, key):
+        conns = self.idle_conns.get(key)
+        while conns:
+            reader, writer = conns.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        scheme, host, port = key
+        if scheme == 'https':
+            reader, writer = await asyncio.open_connection(host, port, ssl=self.ssl_context, server_hostname=host)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return reader, writer, False
+
+    async def read_body(self, reader, headers, fp):
+        '''
+        读取响应内容写入 fp，返回连接是否可复用
+        '''
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            while True:
+                line = await reader.readline()
+                size = int(line.split(b';')[0].strip(), 16)
+                if size == 0:
+                    # 跳过 trailer
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return True
+                await self.copy(reader, fp, size)
+                await reader.readline()
+        length = headers.get('Content-Length')
+        if length is not None:
+            await self.copy(reader, fp, int(length))
+            return True
+        # 无长度信息，读到连接关闭为止
+        while True:
+            data = await reader.read(DOWNLOAD_CHUNK_SIZE)
+            if not data:
+                return False
+            fp.write(data)
+
+    async def copy(self, reader, fp, size):
+        while size > 0:
+            data = await reader.read(min(size, DOWNLOAD_CHUNK_SIZE))
+            if not data:
+                raise asyncio.IncompleteReadError(b'', size)
+            fp.write(data)
+            size -= len(data)
+
+    async def close(self):
+        for conns in self.idle_conns.values():
+            for reader, writer in conns:
+                writer.close()
+        self.idle_conns.clear()
+
+
+class AsyncManager(Manager):
+    '''
+    异步爬虫管理器，在单个事件循环里并发处理链接，替代多个爬虫线程及轮询。
+    链接提取、替换及本地路径复用 Spider 的方法，保存的网站文件与线程模式相同。
+
+    参数：
+        url:                str,    网站地址，格式如为'http://www.xxx.com'；
+        concurrency:        int,    全局并发请求数；
+        host_concurrency:   int,    每个host的并发请求数；
+        resume:             bool,   是否从上次中断的爬取状态继续；
+        update:             bool,   增量更新，用条件请求跳过未修改的链接；
+        processes:          int,    页面处理子进程数，为0则在事件循环里处理页面；
+        dedup:              bool,   下载文件按内容去重存储；
+        verify_pdf:         int,    PDF深度校验子进程数，为0则只做快速检查；
+        bloom:              int,    大于0时用布隆过滤器记录已发现的链接；
+        graph:              str,    链接图导出的文件路径；
+        robots:             bool,   遵守 robots.txt；
+        seed_sitemaps:      bool,   爬虫开始前从 sitemap 放入链接；
+        head_probe:         bool,   后缀未知的链接先用 HEAD 请求探测类型；
+        writers:            int,    页面文件写入线程数，为0则在事件循环里直接写入；
+        fsync:              bool,   写入线程重命名前把文件同步到磁盘；
+        archive:            str,    归档格式'warc'、'tar' 或 'zip'，为空则保存为单独的文件；
+        archive_size:       int,    归档文件超过此字节数后换新文件；
+        hls_workers:        int,    所有 HLS 播放列表共用的分片并发下载数。
+
+    例子：
+        url = 'http://www.daorenjia.com'
+        m = AsyncManager(url, concurrency=1000)
+        m.start()
+    '''
+
+    def __init__(self, url, concurrency=ASYNC_CONCURRENCY, host_concurrency=ASYNC_HOST_CONCURRENCY,
+                 resume=False, update=False, processes=0, dedup=False, verify_pdf=0, bloom=0, graph=None,
+                 robots=False, seed_sitemaps=False, head_probe=False, writers=0, fsync=False,
+                 archive=None, archive_size=ARCHIVE_MAX_SIZE, hls_workers=HLS_WORKERS):
+        Manager.__init__(self, url, resume, update, processes, dedup, verify_pdf, bloom, graph, robots, seed_sitemaps,
+                         head_probe, writers, fsync, archive, archive_size, hls_workers)
+        self.concurrency = concurrency
+        self.host_concurrency = host_concurrency
+        self.spider = None
+        self.fetcher = None
+        self.hls_semaphore = None
+        self.waiters = deque()
+
+    def wakeup(self, all_waiters=False):
+        '''
+        唤醒等待链接的协程，队列有新链接时唤醒一个，全部完成时唤醒所有
+        '''
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                if not all_waiters:
                     break
 
-        # 释放爬虫线程资源
-        [spider.close() for spider in self.spiders]
-        time.sleep(SPIDER_GET_LINK_TIMEOUT + 2)
+    async def get_res(self, link, meta=None):
+        '''
+        获取 html 、 css 链接的响应，返回内容及响应头；未修改返回 NOT_MODIFIED
+        '''
+        headers = self.spider.make_conditional_headers(meta)
+        num_tries = 0
+        # 多次尝试获取，失败后按退避时间等待
+        while True:
+            try:
+                status, res_headers, content = await self.fetcher.fetch(link, headers=headers,
+                                                                         timeout=SOCKET_DEFAULT_TIMEOUT)
+                scheduler.record(link)
+                metrics.incr('requests')
+                break
+            except Exception as e:
+                num_tries += 1
+                logger.warning('[{}]\t {} retry{}'.format(repr(e), link, num_tries))
+                if not await self.wait_retry(link, num_tries, e):
+                    logger.error('[failed get]\t{0}'.format(link))
+                    self.spider.error_links.add(link)
+                    return None
+        if status == 304:
+            metrics.incr('not_modified')
+            logger.info('Not modified\t{}'.format(link))
+            return NOT_MODIFIED
+        metrics.incr('bytes', len(content))
+        return content, res_headers
+
+    async def handle_html(self, link):
+        meta = self.spider.get_meta(link)
+        res = await self.get_res(link, meta)
+        if res is None:
+            self.spider.add_graph(link, 'failed')
+            return []
+        # 未修改则沿用上次的链接
+        if res is NOT_MODIFIED:
+            self.spider.add_graph(link, 304, links=meta['links'])
+            return meta['links']
+        content, headers = res
+        if self.page_pool is not None:
+            # 在线程里等待子进程处理页面，不阻塞事件循环
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self.spider.handle_content, link, content, headers, meta
+            )
+        return self.spider.handle_content(link, content, headers, meta)
+
+    async def probe(self, link):
+        '''
+        用 HEAD 请求探测链接类型，返回链接所属通道；失败则按页面处理
+        '''
+        try:
+            status, res_headers, content = await self.fetcher.fetch(link, method='HEAD',
+                                                                     timeout=SOCKET_DEFAULT_TIMEOUT)
+            scheduler.record(link)
+            metrics.incr('requests')
+            metrics.incr('probes')
+        except Exception as e:
+            scheduler.record(link, e)
+            logger.warning('[{}]\t probe {}'.format(repr(e), link))
+            return 'page'
+        return response_lane(res_headers)
+
+    async def handle_playlist(self, link, depth=0):
+        '''
+        处理 HLS 播放列表，所有播放列表的分片共用 hls_workers 个并发下载，其他同 Spider.handle_playlist
+        '''
+        meta = self.spider.get_meta(link)
+        res = await self.get_res(link, meta)
+        if res is None:
+            self.spider.add_graph(link, 'failed')
+            return []
+        if res is NOT_MODIFIED:
+            self.spider.add_graph(link, 304, links=meta['links'])
+            for playlist in [playlist for playlist in meta['links'] if is_playlist_link(playlist)]:
+                await self.handle_playlist(playlist, depth + 1)
+            return []
+        content, headers = res
+        digest = hashlib.sha1(content).hexdigest()
+        if meta and meta['digest'] == digest:
+            logger.info('Unchanged\t{}'.format(link))
+            metrics.incr('unchanged')
+            self.spider.save_meta(link, headers, digest, meta['links'])
+            self.spider.add_graph(link, 200, headers, len(content), meta['links'])
+            for playlist in [playlist for playlist in meta['links'] if is_playlist_link(playlist)]:
+                await self.handle_playlist(playlist, depth + 1)
+            return []
+        text, encoding = self.spider.decode_res(link, content, headers.get_content_charset())
+        if text is None:
+            return []
+        new_text, playlists, segments = self.spider.rewrite_playlist(link, text, depth)
+        logger.info('playlist\t{}: {} playlists, {} segments'.format(link, len(playlists), len(segments)))
+        metrics.incr('hls_segments', len(segments))
+
+        async def download_segment(segment):
+            async with self.hls_semaphore:
+                await self.download(segment, 'media')
+
+        await asyncio.gather(*[download_segment(segment) for segment in segments])
+        for playlist in playlists:
+            await self.handle_playlist(playlist, depth + 1)
+        self.spider.save_link_file(link, new_text, encoding, headers)
+        self.spider.save_meta(link, headers, digest, playlists + segments)
+        self.spider.add_graph(link, 200, headers, len(content), playlists + segments)
+        return []
+
+    async def download(self, link, lane=None):
+        '''
+        直接下载链接文件，大文件通道的链接用较长的超时时间
+        '''
+        lane = lane or link_lane(link)
+        timeout = SOCKET_DEFAULT_TIMEOUT
+        if lane == 'media':
+            timeout = SOCKET_DOWNLOAD_TIMEOUT
+        meta = self.spider.get_meta(link)
+        headers = self.spider.make_conditional_headers(meta)
+        num_tries = 0
+        # 多次尝试下载，失败后按退避时间等待
+        while True:
+            try:
+                file_path, part = self.spider.open_part(link)
+
+                # 如果文件存在则不重新下载，增量更新时发送条件请求
+                size = None if self.update else self.spider.get_saved_size(file_path, link)
+                if size is not None:
+                    logger.info('exists \t{0}'.format(link))
+                    self.spider.add_graph(link, 'exists', size=size)
+                    return
+                # 先写入临时文件，已有部分内容则续传
+                try:
+                    status, res_headers, content = await self.fetcher.fetch(
+                        link, part.open, dict(headers, **part.range_headers()), timeout=timeout, lane=lane
+                    )
+                finally:
+                    part.close()
+                scheduler.record(link)
+                metrics.incr('requests')
+                if status == 304:
+                    metrics.incr('not_modified')
+                    logger.info('Not modified\t{}'.format(link))
+                    self.spider.add_graph(link, 304)
+                    return
+                metrics.incr('bytes', part.size - part.offset)
+                self.spider.save_meta(link, res_headers, self.spider.commit_part(link, part))
+                self.spider.add_graph(link, status, res_headers, part.size)
+                break
+            except Exception as e:
+                if isinstance(e, HTTPError) and e.code == 416:
+                    part.discard()
+                num_tries += 1
+                logger.warning('[{}]\t {} retry{}'.format(repr(e), link, num_tries))
+                if not await self.wait_retry(link, num_tries, e):
+                    logger.error('[failed download]\t{0}'.format(link))
+                    self.spider.error_links.add(link)
+                    self.spider.add_graph(link, 'failed')
+                    return
+        logger.info('Downloaded\t{0}'.format(link))
+
+    async def wait_retry(self, link, num_tries, error):
+        '''
+        记录失败，需要重试则按退避时间等待后返回 True
+        '''
+        scheduler.record(link, error)
+        if num_tries >= MAX_TRY or not scheduler.is_retryable(error):
+            metrics.incr('failed')
+            return False
+        metrics.incr('retries')
+        await asyncio.sleep(scheduler.backoff(link, num_tries, error))
+        return True
+
+    async def handle(self, link):
+        logger.info("handle: {}".format(link))
+        links = []
+        # 协程交替执行，线程CPU时间不能按链接区分，只记录耗时
+        start = time.perf_counter()
+
+        try:
+            # 后缀未知的链接先探测类型，不是页面则移到对应通道
+            if self.frontier.needs_probe(link):
+                lane = await self.probe(link)
+                if lane != 'page':
+                    self.frontier.defer(link, lane)
+                    self.wakeup()
+                    return DEFERRED
+            # 按链接所在通道处理
+            lane = self.frontier.get_lane(link)
+            if is_playlist_link(link):
+                links = await self.handle_playlist(link)
+            elif lane == 'page':
+                links = await self.handle_html(link)
+            else:
+                await self.download(link, lane)
+        finally:
+            metrics.handled('async', time.perf_counter() - start)
+        return links
+
+    async def work(self):
+        while True:
+            link = self.frontier.pop()
+            if link is None:
+                # 全部链接完成则退出，否则等待新链接
+                if self.frontier.is_finished():
+                    return
+                waiter = asyncio.get_running_loop().create_future()
+                self.waiters.append(waiter)
+                await waiter
+                continue
+            await self.process(link)
+
+    async def process(self, link):
+        '''
+        处理从链接队列取出的链接，新链接放入队列并唤醒等待的协程，完成后通知队列
+        '''
+        failed = True
+        links = []
+        try:
+            links = await self.handle(link)
+            if links is DEFERRED:
+                return
+            for new_link in links:
+                if self.frontier.put(new_link):
+                    self.wakeup()
+            failed = link in self.spider.error_links
+        except Exception:
+            logger.error('{}, {}'.format(link, traceback.format_exc()))
+        finally:
+            # 移到其他通道的链接稍后再处理
+            if links is not DEFERRED:
+                self.frontier.task_done(link, failed, not self.spider.is_write_pending(link) or failed)
+                if self.frontier.is_finished():
+                    self.wakeup(all_waiters=True)
+                elif self.frontier.qsize():
+                    # 通道占用减少，等待的协程可能可以取出链接
+                    self.wakeup()
+
+    async def run_workers(self, num):
+        self.frontier.set_workers(num)
+        await asyncio.gather(*[self.work() for i in range(num)])
+
+    async def crawl(self, home_dir, netloc):
+        # 将网址放入队列
+        self.setup_robots()
+        self.seed_frontier(home_dir)
+        self.start_pdf_verifier()
+
+        # spider 不启动线程，仅用于处理链接及保存文件
+        self.spider = Spider(None, home_dir, netloc, self.state, self.update, self.page_pool, self.blob_store,
+                             self.graph, self.writer, self.archive)
+        self.spiders = [self.spider]
+        self.fetcher = AsyncFetcher(self.host_concurrency, connection_pool.pool_size)
+        self.hls_semaphore = asyncio.Semaphore(self.hls_workers)
+        await self.run_workers(self.concurrency)
+
+        ''' 将失败的链接重新加入队列，仅一次 '''
+        error_links = self.get_error_links() | self.verify_pdfs()
+        logger.info('error links: {}, len={}'.format(error_links, len(error_links)))
+        if len(error_links):
+            logger.info("Concurrency reduce to {}, and try error link again.".format(TRY_ERROR_LINK_THREAD_NUM))
+            self.frontier.retry(error_links)
+            await self.run_workers(TRY_ERROR_LINK_THREAD_NUM)
+        await self.fetcher.close()
+
+    def start(self):
+        home_dir, netloc = self.make_home_dir()
+
+        logger.info("start...")
+        logger.info("Concurrency: {}, per host: {}".format(self.concurrency, self.host_concurrency))
+        self.start_page_pool(home_dir, netloc)
+        self.start_writer()
+        self.open_archive(home_dir)
+        self.open_blob_store(home_dir)
+        self.open_link_graph()
+        asyncio.run(self.crawl(home_dir, netloc))
+        self.finish()
+
+
+def read_seed_urls(path):
+    '''
+    读取批量爬取的网址文件，每行一个网址，忽略空行及#开头的注释
+    '''
+    with open(path, encoding='utf-8') as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+class BatchManager(object):
+    '''
+    批量爬取管理器，多个网站共用一组爬虫线程(异步引擎为一个事件循环里的协程)、连接池、写入线程及页面处理进程池；
+    每个网站仍有各自的链接队列、爬取状态及保存目录。按网站轮流取出链接，每个网站处理中的链接先限制在
+    爬虫数的平均份额内，其他网站没有可取的链接时不限制，爬虫不会空闲。
+
+    参数：
+        urls:       list,   网站地址列表，同一网站点的网址只爬取第一个；
+        workers:    int,    共用的爬虫线程数，异步引擎为全局并发请求数；
+        engine:     str,    爬取引擎'thread' 或 'async'；
+        host_concurrency:   int,    异步引擎每个host的并发请求数；
+        processes:  int,    共用的页面处理子进程数，为0则在爬虫里处理页面；
+        writers:    int,    共用的页面文件写入线程数，为0则在爬虫里直接写入；
+        fsync:      bool,   写入线程重命名前把文件同步到磁盘；
+        options:    其他参数传给每个网站的 Manager，如 resume、update、dedup、robots、archive 等，不支持 graph。
+
+    例子：
+        urls = ['http://www.daorenjia.com', 'https://zhms8.com']
+        m = BatchManager(urls, workers=32)
+        m.start()
+    '''
+
+    def __init__(self, urls, workers=THREAD_NUM, engine='thread', host_concurrency=ASYNC_HOST_CONCURRENCY,
+                 processes=0, writers=0, fsync=False, **options):
+        self.workers = workers
+        self.engine = engine
+        self.host_concurrency = host_concurrency
+        self.processes = processes
+        self.writers = writers
+        self.fsync = fsync
+        self.hls_workers = options.get('hls_workers', HLS_WORKERS)
+        self.sites = []
+        netlocs = set()
+        for url in urls:
+            if engine == 'async':
+                site = AsyncManager(url, workers, host_concurrency, **options)
+            else:
+                site = Manager(url, **options)
+            # 同一网站点共用保存目录及爬取状态，不能同时爬取
+            netloc = urlparse(site.url).netloc
+            if netloc in netlocs:
+                logger.warning('same site as a previous url, skipped: {}'.format(url))
+                continue
+            netlocs.add(netloc)
+            self.sites.append(site)
+        # 所有网站的链接队列共用一个条件变量，爬虫可以等待任一网站的新链接
+        self.cond = threading.Condition()
+        for site in self.sites:
+            site.frontier.cond = self.cond
+        self.next_site = 0
+        self.executor = None
+        self.writer = None
+        self.hls_pool = None
+        self.fetcher = None
+        self.hls_semaphore = None
+        self.waiters = deque()
+        metrics.gauge('queue_depth', lambda: sum(site.frontier.qsize() for site in self.sites))
+        metrics.gauge('unfinished', lambda: sum(site.frontier.unfinished for site in self.sites))
+        metrics.gauge('sites', lambda: len([site for site in self.sites if not site.frontier.is_finished()]))
+
+    def open_site(self, site):
+        '''
+        打开网站的保存目录、爬取状态及存储，放入网址；共用的写入线程、分片下载线程池及进程池由批量管理器提供
+        '''
+        home_dir, netloc = site.make_home_dir()
+        logger.info('site: {}, home dir: {}'.format(site.url, home_dir))
+        site.writer = self.writer
+        site.hls_pool = self.hls_pool
+        site.open_archive(home_dir)
+        if self.executor is not None:
+            if site.archive_kind:
+                logger.warning('page processes are not used with --archive, pages are handled in the crawler')
+            else:
+                site.page_pool = PagePool(self.processes, home_dir, netloc, site.update, executor=self.executor)
+        site.open_blob_store(home_dir)
+        site.setup_robots()
+        site.seed_frontier(home_dir)
+        site.start_pdf_verifier()
+
+        # 每个网站一个 Spider 处理链接，由共用的爬虫线程调用，不启动线程
+        queue = site.frontier if self.engine == 'thread' else None
+        site.spider = Spider(queue, home_dir, netloc, site.state, site.update, site.page_pool, site.blob_store,
+                             None, self.writer, site.archive, self.hls_pool)
+        site.spiders = [site.spider]
+
+    def set_workers(self, num):
+        for site in self.sites:
+            site.frontier.set_workers(num)
+
+    def is_finished(self):
+        return all(site.frontier.is_finished() for site in self.sites)
+
+    def pick(self):
+        '''
+        从上次取出的下一个网站开始轮流取出链接，返回 (网站, 链接)，没有可取的链接返回 (None, None)；
+        先跳过处理中的链接已达到平均份额的网站，都取不到时不限制
+        '''
+        num = len(self.sites)
+        unfinished = len([site for site in self.sites if not site.frontier.is_finished()])
+        share = -(-self.workers // max(1, unfinished))
+        for fair in (True, False):
+            for i in range(num):
+                site = self.sites[(self.next_site + i) % num]
+                if fair and sum(site.frontier.active.values()) >= share:
+                    continue
+                link = site.frontier.pick()
+                if link is not None:
+                    self.next_site = (self.next_site + i + 1) % num
+                    return site, link
+        return None, None
+
+    def pop(self):
+        with self.cond:
+            return self.pick()
+
+    def get(self):
+        '''
+        阻塞地取出链接，所有网站的链接完成后返回 (None, None)
+        '''
+        with self.cond:
+            while True:
+                site, link = self.pick()
+                if link is not None:
+                    return site, link
+                if self.is_finished():
+                    return None, None
+                self.cond.wait()
+
+    def work(self):
+        logger.info('{} start.'.format(threading.current_thread().name))
+        while True:
+            site, link = self.get()
+            if link is None:
+                break
+            site.spider.process(link)
+        logger.info('{} end.'.format(threading.current_thread().name))
+
+    def run_threads(self, num):
+        '''
+        启动共用的爬虫线程，等待所有网站的链接完成
+        '''
+        self.set_workers(num)
+        threads = [threading.Thread(target=self.work, daemon=True) for i in range(num)]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+
+    async def work_async(self):
+        while True:
+            site, link = self.pop()
+            if link is None:
+                # 全部网站完成则退出，否则等待新链接
+                if self.is_finished():
+                    return
+                waiter = asyncio.get_running_loop().create_future()
+                self.waiters.append(waiter)
+                await waiter
+                continue
+            await site.process(link)
+
+    async def run_async(self, num):
+        self.set_workers(num)
+        await asyncio.gather(*[self.work_async() for i in range(num)])
+
+    async def crawl_async(self):
+        # 所有网站共用异步客户端及等待队列，任一网站有新链接都可以唤醒协程
+        self.fetcher = AsyncFetcher(self.host_concurrency, connection_pool.pool_size)
+        self.hls_semaphore = asyncio.Semaphore(self.hls_workers)
+        for site in self.sites:
+            site.fetcher = self.fetcher
+            site.hls_semaphore = self.hls_semaphore
+            site.waiters = self.waiters
+        await self.run_async(self.workers)
+        if self.retry_errors():
+            logger.info("Concurrency reduce to {}, and try error link again.".format(TRY_ERROR_LINK_THREAD_NUM))
+            await self.run_async(TRY_ERROR_LINK_THREAD_NUM)
+        await self.fetcher.close()
+
+    def retry_errors(self):
+        '''
+        把各网站失败的链接及深度校验失败的PDF文件重新放入各自的队列，返回放入的链接数
+        '''
+        num = 0
+        for site in self.sites:
+            error_links = site.get_error_links() | site.verify_pdfs()
+            logger.info('{} error links: {}, len={}'.format(site.url, error_links, len(error_links)))
+            if error_links:
+                site.frontier.retry(error_links)
+                num += len(error_links)
+        return num
+
+    def finish(self):
+        # 先等待共用的写入线程写完，再关闭各网站；共用的进程池最后关闭
+        if self.writer is not None:
+            self.writer.close()
+        for site in self.sites:
+            site.writer = None
+            site.hls_pool = None
+            site.page_pool = None
+            site.close()
+        if self.hls_pool is not None:
+            self.hls_pool.shutdown()
+        if self.executor is not None:
+            self.executor.shutdown()
+        logger.info('path cache: {}, rel link cache: {}'.format(path_cache.stats(), rel_link_cache.stats()))
+        logger.info('metrics: {}'.format(metrics.summary()))
 
         # 响铃提醒下载完成
-        for i in range(6):
+        for i in range(6 if BELL else 0):
             print('\a')
             time.sleep(0.5)
 
         logger.info("finish.")
 
+    def start(self):
+        if not self.sites:
+            logger.warning('no site to crawl.')
+            return
+        logger.info("batch start: {} sites, {} workers".format(len(self.sites), self.workers))
+        if self.processes > 0:
+            logger.info("Page process number: {}".format(self.processes))
+            self.executor = ProcessPoolExecutor(self.processes)
+            # 在爬虫线程启动前创建子进程
+            self.executor.submit(int).result()
+        if self.writers > 0:
+            logger.info("Writer thread number: {}".format(self.writers))
+            self.writer = FileWriter(self.writers, WRITER_QUEUE_SIZE, self.fsync)
+        if self.engine == 'thread' and self.hls_workers > 0:
+            self.hls_pool = ThreadPoolExecutor(self.hls_workers, thread_name_prefix='hls')
+        # 每个host保持的空闲连接数不超过爬虫数的平均份额，空闲连接总数随网站数不增长
+        connection_pool.pool_size = min(connection_pool.pool_size, max(1, self.workers // len(self.sites)))
+        for site in self.sites:
+            self.open_site(site)
+
+        if self.engine == 'async':
+            asyncio.run(self.crawl_async())
+        else:
+            self.run_threads(self.workers)
+            ''' 将失败的链接重新加入队列，仅一次 '''
+            if self.retry_errors():
+                logger.info("Thread reduce to {}, and try error link again.".format(TRY_ERROR_LINK_THREAD_NUM))
+                self.run_threads(TRY_ERROR_LINK_THREAD_NUM)
+        for site in self.sites:
+            error_links = site.get_error_links()
+            if error_links:
+                logger.info('{} error links: {}, len={}'.format(site.url, error_links, len(error_links)))
+        self.finish()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-u', '--url', help="url link, default='http://www.daorenjia.com/'",
                         type=str, default='http://www.daorenjia.com/')
+    parser.add_argument('--batch', help="crawl all urls in this file (one per line, # for comments) with one shared "
+                        "pool of workers, connections, writers and page processes", type=str, default=None)
+    parser.add_argument('--threads', help="crawler threads shared by all sites of --batch with the thread engine, "
+                        "default={}".format(THREAD_NUM),
+                        type=int, default=THREAD_NUM)
+    parser.add_argument('-e', '--engine', help="crawl engine, 'thread' or 'async', default='thread'",
+                        type=str, choices=['thread', 'async'], default='thread')
+    parser.add_argument('-c', '--concurrency', help="async engine concurrency, default={}".format(ASYNC_CONCURRENCY),
+                        type=int, default=ASYNC_CONCURRENCY)
+    parser.add_argument('--host-concurrency',
+                        help="concurrency per host, default={} for async engine, {} for thread engine".format(
+                            ASYNC_HOST_CONCURRENCY, THREAD_NUM),
+                        type=int, default=None)
+    parser.add_argument('--rate', help="max requests per second per host, 0 for no limit, default={}".format(HOST_RATE),
+                        type=float, default=HOST_RATE)
+    parser.add_argument('--pool-size', help="idle keep-alive connections kept per host, default={}".format(POOL_SIZE),
+                        type=int, default=POOL_SIZE)
+    parser.add_argument('-p', '--processes', help="page processing processes, 0 to handle pages in the crawler, default=0",
+                        type=int, default=0)
+    parser.add_argument('--resume', help="resume the frontier saved by the last interrupted run",
+                        action='store_true')
+    parser.add_argument('--update', help="incremental update, skip links not modified since the last run",
+                        action='store_true')
+    parser.add_argument('--dedup', help="store downloaded files once per content hash and hardlink them into place",
+                        action='store_true')
+    parser.add_argument('--verify-pdf', help="processes for deep PDF verification in the background, 0 for header "
+                        "and trailer checks only, default=0", type=int, default=0)
+    parser.add_argument('--bloom', help="track seen links with a bloom filter sized for N links, confirmed against "
+                        "the crawl state, 0 for 64-bit fingerprints, default=0", type=int, default=0)
+    parser.add_argument('--graph', help="stream the link graph to this JSON lines file", type=str, default=None)
+    parser.add_argument('--sitemap', help="write a sitemap.xml of the fetched links when finished",
+                        type=str, default=None)
+    parser.add_argument('--robots', help="obey robots.txt disallow rules and crawl delay", action='store_true')
+    parser.add_argument('--seed-sitemaps', help="put all links of the sitemaps listed in robots.txt (or /sitemap.xml) "
+                        "into the queue before crawling", action='store_true')
+    parser.add_argument('--drop-params', help="comma separated query parameters removed when canonicalizing links, "
+                        "wildcards allowed, empty to keep all, default={}".format(','.join(TRACKING_PARAMS)),
+                        type=str, default=','.join(TRACKING_PARAMS))
+    parser.add_argument('--head-probe', help="send HEAD requests for links with unknown suffixes to queue them as "
+                        "pages, small assets or large media by Content-Type and Content-Length", action='store_true')
+    parser.add_argument('--writers', help="threads writing page files from a bounded queue, 0 to write in the "
+                        "crawler, default=0", type=int, default=0)
+    parser.add_argument('--fsync', help="fsync page files written by the writer threads before renaming them",
+                        action='store_true')
+    parser.add_argument('--archive', help="append pages and downloads to rolling uncompressed archives with an "
+                        "offset index instead of one file per link", type=str, choices=ArchiveStore.KINDS, default=None)
+    parser.add_argument('--archive-size', help="MB per archive file before rolling over, default={}".format(
+                        ARCHIVE_MAX_SIZE // 1024 // 1024), type=int, default=ARCHIVE_MAX_SIZE // 1024 // 1024)
+    parser.add_argument('--extract-archive', help="extract an archive directory to the one file per link layout "
+                        "in the current directory and exit", type=str, default=None)
+    parser.add_argument('--hls-workers', help="concurrent segment downloads shared by all HLS playlists, default={}".format(
+                        HLS_WORKERS), type=int, default=HLS_WORKERS)
+    parser.add_argument('--metrics', help="write a JSON metrics snapshot to this file periodically",
+                        type=str, default=None)
+    parser.add_argument('--metrics-interval',
+                        help="seconds between metrics snapshots, default={}".format(METRICS_INTERVAL),
+                        type=float, default=METRICS_INTERVAL)
+    parser.add_argument('--metrics-port', help="serve metrics as text on this local port, 0 to disable, default=0",
+                        type=int, default=0)
+    parser.add_argument('--log-level', help="log level, WARNING skips the per-link logs, default=INFO",
+                        type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO')
     args = parser.parse_args()
 
     # url = "https://zhms8.com/tag/daojiadianji/"
     # url = 'http://www.daorenjia.com/'
     url = args.url
-    m = Manager(url)
+    logger.setLevel(args.log_level)
+    connection_pool.pool_size = args.pool_size
+    scheduler.rate = args.rate
+    canonicalizer.set_drop_params([name for name in args.drop_params.split(',') if name])
+    # 生成 sitemap 需要链接图
+    graph = args.graph or ('{}.graph.jsonl'.format(args.sitemap) if args.sitemap else None)
+    archive_size = args.archive_size * 1024 * 1024
+    if args.extract_archive:
+        extract_archive(args.extract_archive)
+        sys.exit(0)
+    if args.batch:
+        if graph:
+            logger.warning('--graph and --sitemap are not supported with --batch, ignored')
+            graph = args.sitemap = None
+        host_concurrency = args.host_concurrency or ASYNC_HOST_CONCURRENCY
+        workers = args.concurrency if args.engine == 'async' else args.threads
+        if args.engine == 'thread':
+            scheduler.concurrency = args.host_concurrency or workers
+        m = BatchManager(read_seed_urls(args.batch), workers, args.engine, host_concurrency, args.processes,
+                         args.writers, args.fsync, resume=args.resume, update=args.update, dedup=args.dedup,
+                         verify_pdf=args.verify_pdf, bloom=args.bloom, robots=args.robots,
+                         seed_sitemaps=args.seed_sitemaps, head_probe=args.head_probe, archive=args.archive,
+                         archive_size=archive_size, hls_workers=args.hls_workers)
+    elif args.engine == 'async':
+        host_concurrency = args.host_concurrency or ASYNC_HOST_CONCURRENCY
+        m = AsyncManager(url, args.concurrency, host_concurrency, args.resume, args.update, args.processes,
+                         args.dedup, args.verify_pdf, args.bloom, graph, args.robots, args.seed_sitemaps,
+                         args.head_probe, args.writers, args.fsync, args.archive, archive_size, args.hls_workers)
+    else:
+        scheduler.concurrency = args.host_concurrency or THREAD_NUM
+        m = Manager(url, args.resume, args.update, args.processes, args.dedup, args.verify_pdf, args.bloom, graph,
+                    args.robots, args.seed_sitemaps, args.head_probe, args.writers, args.fsync, args.archive,
+                    archive_size, args.hls_workers)
+    reporter = None
+    if args.metrics:
+        reporter = MetricsReporter(args.metrics, args.metrics_interval)
+        reporter.start()
+    metrics_server = serve_metrics(args.metrics_port) if args.metrics_port else None
     m.start()
+    if reporter is not None:
+        reporter.close()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    if args.sitemap:
+        export_sitemap(graph, args.sitemap, url)
 
     # url_parse = urlparse(url)
     # home_dir = "{}-site/".format(url_parse.netloc)